@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Headless fixed-step benchmark for the game loop.
+
+Runs the overworld and each level for a number of scripted frames without a
+display and reports per-phase frame times as percentiles, e.g.:
+
+    python benchmark.py --frames 600 --resolution 1280x960
+
+--pure-python runs it without the compiled game_accel module, and
+--compare-accel checks game_accel against game_accel_py on random inputs
+and times each function in both. --compare-physics checks the batched
+physics step against the per-sprite one.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+PHASES = ['physics', 'update', 'draw', 'ui', 'flip']
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = (len(values) - 1) * p / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def summarize(samples):
+    result = {}
+    for phase, values in samples.items():
+        stats = {f'p{p}': percentile(values, p) for p in PERCENTILES}
+        stats['max'] = max(values, default=0.0)
+        stats['mean'] = sum(values) / len(values) if values else 0.0
+        result[phase] = stats
+    return result
+
+
+def map_script(game, frame):
+    # Walk down and to the left, away from the level trees
+    game.movement.update(-1, -1)
+
+
+def level_script(game, frame):
+    # Walk right and jump in regular pulses
+    game.movement.update(1, 1 if frame % 40 < 10 else 0)
+
+
+def run_scene(game, frames, fps, script):
+    samples = {phase: [] for phase in PHASES + ['total']}
+    timer = time.perf_counter
+    for frame in range(frames):
+        game.delta_time = 1 / fps
+        game.fixed_fps_passed += game.delta_time
+        script(game, frame)
+
+        start = timer()
+        game.physics_step()
+        after_physics = timer()
+        game.update_world()
+        after_update = timer()
+        game.draw_world(game.screen)
+        after_draw = timer()
+        game.draw_ui(game.screen)
+        after_ui = timer()
+        game.pygame.display.flip()
+        end = timer()
+
+        samples['physics'].append((after_physics - start) * 1000)
+        samples['update'].append((after_update - after_physics) * 1000)
+        samples['draw'].append((after_draw - after_update) * 1000)
+        samples['ui'].append((after_ui - after_draw) * 1000)
+        samples['flip'].append((end - after_ui) * 1000)
+        samples['total'].append((end - start) * 1000)
+    return summarize(samples)
+
+
+def reset_player(game):
+    game.player.position.update(0, 0)
+    game.player.vertical_velocity = 0
+    game.camera.position.update(0, 0)
+    game.movement.update(0, 0)
+
+
+def time_level_load(game, number, use_cache):
+    start = time.perf_counter()
+    game.LevelData(number, use_cache=use_cache)
+    return (time.perf_counter() - start) * 1000
+
+
+def import_game(args):
+    os.environ['MAROONED_HEADLESS'] = '1'
+    os.environ['MAROONED_RESOLUTION'] = args.resolution
+    if args.pure_python:
+        os.environ['MAROONED_PURE_PYTHON'] = '1'
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import game
+    return game
+
+
+def run_benchmark(args):
+    start = time.perf_counter()
+    game = import_game(args)
+    game.init()
+    game.load_ui_assets().result()
+    game.apply_loaded_assets()
+    results = {'startup_ms': (time.perf_counter() - start) * 1000, 'scenes': {},
+               'accel': game.accel.__name__}
+
+    levels = game.GameStartingItem.levels
+    numbers = args.levels if args.levels is not None else [level.number for level in levels]
+
+    reset_player(game)
+    run_scene(game, args.warmup, args.fps, map_script)
+    results['scenes']['map'] = run_scene(game, args.frames, args.fps, map_script)
+
+    for number in numbers:
+        level = levels[number]
+        cold_ms = time_level_load(game, number, use_cache=False)
+        warm_ms = time_level_load(game, number, use_cache=True)
+        reset_player(game)
+        level.start()
+        run_scene(game, args.warmup, args.fps, level_script)
+        scene = run_scene(game, args.frames, args.fps, level_script)
+        scene['cold_load_ms'] = cold_ms
+        scene['warm_load_ms'] = warm_ms
+        results['scenes'][f'level{number}'] = scene
+        game.GameStartingItem.exit_level()
+
+    results['transform_cache'] = game.transform_cache.stats()
+    game.pygame.quit()
+    return results
+
+
+def print_report(results, out=sys.stdout):
+    print(f"hot paths: {results['accel']}", file=out)
+    print(f"startup: {results['startup_ms']:.1f} ms", file=out)
+    columns = [f'p{p}' for p in PERCENTILES] + ['max', 'mean']
+    for name, scene in results['scenes'].items():
+        title = name
+        if 'cold_load_ms' in scene:
+            title += (f" (cold load {scene['cold_load_ms']:.1f} ms,"
+                      f" warm load {scene['warm_load_ms']:.1f} ms)")
+        print(f'\n{title}', file=out)
+        print(f"  {'phase':<8}" + ''.join(f'{c:>9}' for c in columns), file=out)
+        for phase in PHASES + ['total']:
+            stats = scene[phase]
+            print(f'  {phase:<8}' + ''.join(f'{stats[c]:>9.3f}' for c in columns), file=out)
+    cache = results['transform_cache']
+    print(f"\ntransform cache: {cache['hits']} hits, {cache['misses']} misses, "
+          f"{cache['entries']} entries, {cache['bytes'] / 1024:.0f} KiB", file=out)
+
+
+def accel_cases(seed, count):
+    """Random arguments for each game_accel function, by name."""
+    import numpy as np
+    from pygame import Rect
+    rng = random.Random(seed)
+    grid = np.random.default_rng(seed).integers(0, 6, (64, 48), dtype=np.uint8)
+    collidable = np.array([0, 0, 0, 0, 1, 1], np.uint8)
+
+    def coordinate(low, high):
+        # Half the time on a .5 boundary, where rounding is easiest to get wrong
+        if rng.random() < 0.5:
+            return rng.randint(low * 2, high * 2) / 2
+        return rng.uniform(low, high)
+
+    def contact_case():
+        (x, y) = (coordinate(-2, 66), coordinate(-2, 50))
+        (camera_x, camera_y) = (coordinate(0, 60), coordinate(0, 40))
+        (scale, screen_height) = (rng.choice([80.0, 160.0, 96.0]), rng.choice([480.0, 960.0]))
+        # A rect around where the sprite would be drawn, sometimes empty
+        left = int((x + 12.0 - camera_x) * scale) + rng.randint(-100, 100)
+        top = int(screen_height - (y + 9.5 - camera_y) * scale) + rng.randint(-100, 100)
+        (width, height) = rng.choice([(0, 0), (int(scale), int(scale)), (rng.randint(1, 200), rng.randint(1, 200))])
+        return (grid, collidable, x, y, left, top, width, height, camera_x, camera_y,
+                12.0, 9.5, scale, screen_height, 50 * 4 / 3, 50)
+
+    colors = np.array([0xffffff, 0x8080ff, 0x006080, 0x008000], np.uint32)
+    pixels = np.random.default_rng(seed).choice(
+        np.append(colors, np.uint32(0x123456)), (160, 90)).astype(np.uint32)
+    return {
+        'tile_contacts': [contact_case() for _ in range(count)],
+        'place_rect': [
+            (Rect(0, 0, 0, 0), Rect(rng.randint(-8, 0), rng.randint(-8, 0), rng.randint(1, 160), rng.randint(1, 160)),
+             coordinate(-10, 80), coordinate(-10, 60), coordinate(0, 60), coordinate(0, 40),
+             12.0, 9.5, rng.choice([80.0, 160.0, 96.0]), rng.choice([480.0, 960.0]),
+             50 * 4 / 3, 50, rng.random() < 0.5)
+            for _ in range(count)
+        ],
+        'view_origin': [
+            (-40.0, 32.0, coordinate(-60, 60), coordinate(-20, 40), 12.0, 9.5,
+             rng.choice([80.0, 160.0]), rng.choice([480.0, 960.0]))
+            for _ in range(count)
+        ],
+        'step_velocity': [
+            (rng.uniform(-0.3, 0.3), rng.random() < 0.5, rng.random() < 0.5, -0.005)
+            for _ in range(count)
+        ],
+        'classify_pixels': [(pixels, colors)] * max(1, count // 1000),
+    }
+
+
+def call(function, case):
+    """Call function on copies of any Rects in case, returning the result
+    and the Rects, which some functions update in place."""
+    from pygame import Rect
+    case = [Rect(arg) if isinstance(arg, Rect) else arg for arg in case]
+    return (function(*case), [tuple(arg) for arg in case if isinstance(arg, Rect)])
+
+
+def same_result(a, b):
+    if hasattr(a, 'shape'):
+        return a.shape == b.shape and (a == b).all()
+    return a == b
+
+
+def compare_accel(args):
+    """Check the compiled hot paths against the pure-Python ones and time both."""
+    import game_accel_py
+    try:
+        import game_accel
+    except ImportError:
+        print('game_accel is not built, run: python setup.py build_ext --inplace')
+        return 1
+    failed = False
+    print(f"  {'function':<16}{'calls':>8}{'mismatches':>12}{'python us':>12}{'compiled us':>13}")
+    for (name, cases) in accel_cases(args.seed, args.frames * 10).items():
+        functions = (getattr(game_accel_py, name), getattr(game_accel, name))
+        mismatches = 0
+        for case in cases:
+            (results, rects) = zip(*(call(function, case) for function in functions))
+            mismatches += not (same_result(*results) and rects[0] == rects[1])
+        failed = failed or mismatches
+        times = []
+        for function in functions:
+            start = time.perf_counter()
+            for case in cases:
+                function(*case)
+            times.append((time.perf_counter() - start) / len(cases) * 1e6)
+        print(f'  {name:<16}{len(cases):>8}{mismatches:>12}{times[0]:>12.2f}{times[1]:>13.2f}')
+    return 1 if failed else 0
+
+
+def physics_trace(game, level, args, batched):
+    """State of every physics body and the death count after each tick of
+    a level with args.enemies extra enemies, as the camera follows the
+    player and then pans across the level."""
+    game.BATCHED_PHYSICS = batched
+    game.BATCHED_PHYSICS_MIN_SPRITES = 0
+    rng = random.Random(args.seed)
+    (width, height) = level.data.size
+    level.start()
+    for enemy in game.Enemy.enemies:
+        # Enemy.reset() leaves the rotation from the last run
+        enemy.rotation = 0
+    enemies = [
+        game.Enemy(game.Vector2(rng.uniform(0, width), rng.uniform(1, height)), rng.choice([-1, 1]))
+        for _ in range(args.enemies)
+    ]
+    game.Enemy.enemies.extend(enemies)
+    for enemy in enemies:
+        enemy.activate()
+    bodies = game.Enemy.enemies + [game.player]
+    deaths = game.save_game['death_count']
+    trace = []
+    for frame in range(args.frames):
+        level_script(game, frame)
+        if frame < args.frames // 2:
+            # Follow the player so enemies can reach it, then sweep the level
+            game.camera.position.update(game.player.position)
+        else:
+            game.camera.position.update(frame * 0.15 % (width + 40) - 20, frame * 0.05 % height - 5)
+        game.camera.snap()
+        game.fixed_fps_passed = game.fixed_fps_delta
+        game.physics_step()
+        trace.append(([
+            (body.position.x, body.position.y, body.vertical_velocity, body.rotation,
+             getattr(body, 'movement_direction', 0))
+            for body in bodies
+        ], game.save_game['death_count'] - deaths))
+    game.GameStartingItem.exit_level()
+    return trace
+
+
+def compare_physics(args):
+    """Check the batched physics step against the per-sprite one, tick for tick."""
+    game = import_game(args)
+    game.init()
+    levels = game.GameStartingItem.levels
+    numbers = args.levels if args.levels is not None else [level.number for level in levels]
+    failed = False
+    print(f"  {'level':<8}{'bodies':>8}{'ticks':>8}{'deaths':>14}  first mismatch")
+    for number in numbers:
+        (single, batched) = (physics_trace(game, levels[number], args, mode) for mode in (False, True))
+        mismatch = next((tick for (tick, (a, b)) in enumerate(zip(single, batched)) if a != b), None)
+        failed = failed or mismatch is not None
+        deaths = f'{single[-1][1]}/{batched[-1][1]}'
+        print(f"  {number:<8}{len(single[0][0]):>8}{len(single):>8}{deaths:>14}  "
+              f"{'none' if mismatch is None else f'tick {mismatch}'}")
+    game.pygame.quit()
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=300,
+                        help='measured frames per scene')
+    parser.add_argument('--warmup', type=int, default=30,
+                        help='unmeasured frames run before each scene')
+    parser.add_argument('--fps', type=float, default=60,
+                        help='simulated render rate, sets delta_time')
+    parser.add_argument('--resolution', default='1280x960',
+                        help='display size as WIDTHxHEIGHT')
+    parser.add_argument('--levels', type=int, nargs='*',
+                        help='level numbers to run (default: all)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the --compare-accel and --compare-physics inputs')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results as JSON to PATH')
+    parser.add_argument('--pure-python', action='store_true',
+                        help="don't use the compiled game_accel module")
+    parser.add_argument('--compare-accel', action='store_true',
+                        help='check game_accel against game_accel_py instead')
+    parser.add_argument('--compare-physics', action='store_true',
+                        help='check the batched physics step against the per-sprite one instead')
+    parser.add_argument('--enemies', type=int, default=200,
+                        help='enemies added to each level by --compare-physics')
+    args = parser.parse_args(argv)
+
+    if args.compare_accel:
+        sys.exit(compare_accel(args))
+    if args.compare_physics:
+        sys.exit(compare_physics(args))
+
+    results = run_benchmark(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
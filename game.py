@@ -1,16 +1,29 @@
 #!/usr/bin/env python3
 
+import time
+
+_import_start = time.perf_counter()
+
+import argparse
+import atexit
+import glob
+import hashlib
+import io
 import json
 import math
 import os
-import pickle
-import random
+import queue
+import re
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
 from sys import stdout
 import threading
-import time
+import zipfile
 from typing import Callable, Union
 
+import numpy as np
 import pygame
 from pygame import Surface
 from pygame.display import Info
@@ -18,6 +31,17 @@ from pygame.event import Event
 from pygame.locals import *
 from pygame.math import *
 
+# Hot paths compiled from game_accel.pyx when it has been built (see
+# setup.py), else the pure-Python game_accel_py. MAROONED_PURE_PYTHON=1
+# forces the latter.
+if os.environ.get('MAROONED_PURE_PYTHON'):
+    import game_accel_py as accel
+else:
+    try:
+        import game_accel as accel
+    except ImportError:
+        import game_accel_py as accel
+
 
 def size_from_ratio(w, h, r):
     rh = w/h
@@ -32,18 +56,54 @@ HEIGHT = 480
 RATIO = 4/3
 # FPS = 60
 FPS = 0
+# With nothing moving for IDLE_DELAY seconds, frames drop to IDLE_FPS and wait
+# on input in between
+IDLE_DELAY = 1
+IDLE_FPS = 10
+# Only redraw and push the parts of the overworld that changed
+DIRTY_RECTS = True
+# More dirty rects than this are merged into one
+MAX_DIRTY_RECTS = 16
 FIXED_FPS = 50
+# Most physics steps run per frame; time beyond that is dropped so a slow frame
+# can't snowball into ever longer ones
+MAX_PHYSICS_STEPS = 5
 SPEED = 3
 CAMERA_SPEED = 1
 PLATFORM_SPEED = 8
 JUMP_SPEED = 0.15
 MOVING_JUMP_SPEED = 0.175
 GRAVITY = -0.005
+# Step the player and enemies together with NumPy instead of one at a time,
+# once there are enough of them to outweigh the array setup
+BATCHED_PHYSICS = True
+BATCHED_PHYSICS_MIN_SPRITES = 128
+# Enemies more than this many units outside the view sleep, taking no part
+# in the physics step until the camera comes back within range
+ENEMY_ACTIVITY_RADIUS = 16
 
 PLAYER_SLICE = (26, 36)
 PLAYER_ANIMATION_COUNT = 3
 PLAYER_ANIMATION_MIN = 350
 
+# Seconds between writes of the save file
+SAVE_INTERVAL = 0.5
+
+# Rotations are rounded to this many degrees before transforming sprites
+TRANSFORM_ANGLE_STEP = 3
+TRANSFORM_CACHE_BUDGET = 32 * 1024 * 1024
+# The overworld background is pre-scaled in tiles of this many map pixels,
+# keeping up to BACKGROUND_CACHE_BUDGET bytes of them
+BACKGROUND_TILE_SIZE = 64
+BACKGROUND_CACHE_BUDGET = 32 * 1024 * 1024
+# Bytes of pre-rendered tile chunks kept by each TileMapLayer, the chunks in
+# view are kept even if they don't fit
+CHUNK_CACHE_BUDGET = 64 * 1024 * 1024
+# Rendered strings and glyphs kept by text_cache
+TEXT_CACHE_SIZE = 256
+# Songs the audio worker keeps read into memory
+AUDIO_PREFETCH_LIMIT = 3
+
 # Define Colors 
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
@@ -53,28 +113,64 @@ BLUE = (0, 0, 255)
 
 mode_2d = False
 
-## initialize pygame and create window
-pygame.init()
-try:
-    pygame.mixer.init()  ## For sound
-except pygame.error:
-    use_sound = False
-else:
-    use_sound = True
-info = Info()
-size = size_from_ratio(info.current_w, info.current_h, RATIO)
-screen = pygame.display.set_mode(size, FULLSCREEN)
-scale_direct = size[0] / WIDTH
+# Headless mode uses SDL's dummy drivers so the game can be simulated without
+# a display (see benchmark.py). MAROONED_RESOLUTION=WIDTHxHEIGHT overrides
+# the display size in either mode.
+HEADLESS = bool(os.environ.get('MAROONED_HEADLESS'))
+if HEADLESS:
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+# Set up by init_display() and init_audio()
+use_sound = False
+size = (WIDTH, HEIGHT)
+screen: Surface = None
+scale_direct = 1
 growness = 50
 scale = scale_direct * growness
 offset = Vector2(640/2/growness, 480/2/growness)
-print('Scale:', scale_direct, scale)
 clock = pygame.time.Clock()     ## For syncing the FPS
 fixed_fps_delta = 1 / FIXED_FPS
 
 
-## group all the sprites together for ease of update
-foreground_sprites = pygame.sprite.Group()
+def init_display(vsync=False):
+    global size, screen, scale_direct, scale, transform_epoch
+    ## initialize pygame and create window
+    # Only what the first frame needs, the mixer is started by init_audio()
+    pygame.display.init()
+    pygame.font.init()
+    if os.environ.get('MAROONED_RESOLUTION'):
+        size = tuple(int(x) for x in os.environ['MAROONED_RESOLUTION'].lower().split('x'))
+    else:
+        info = Info()
+        size = size_from_ratio(info.current_w, info.current_h, RATIO)
+    flags = 0 if HEADLESS else FULLSCREEN
+    screen = None
+    if vsync:
+        try:
+            screen = pygame.display.set_mode(size, flags | SCALED, vsync=1)
+        except pygame.error as e:
+            print('Warning: vsync not available:', e)
+    if screen is None:
+        screen = pygame.display.set_mode(size, flags)
+    scale_direct = size[0] / WIDTH
+    scale = scale_direct * growness
+    transform_epoch += 1
+    print('Scale:', scale_direct, scale)
+
+
+def init_audio():
+    global use_sound
+    if HEADLESS:
+        return
+    try:
+        pygame.mixer.init()  ## For sound
+    except pygame.error:
+        use_sound = False
+    else:
+        use_sound = True
+        audio.start()
+    play_map_music()
 
 
 def clamp(x, mi, ma):
@@ -94,31 +190,179 @@ def rot_center(image, angle):
     return rotated_image, new_rect
 
 
+class TransformCache:
+    """LRU cache of scaled and rotated surfaces shared by all sprites.
+
+    Entries are keyed on the identity of the source surface, the target size
+    and the rotation rounded to TRANSFORM_ANGLE_STEP. The source surface is
+    kept alive by its entry so its id can't be reused while cached.
+    """
+
+    def __init__(self, budget=TRANSFORM_CACHE_BUDGET):
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, surface: Surface, size, angle):
+        angle = round(angle / TRANSFORM_ANGLE_STEP) * TRANSFORM_ANGLE_STEP % 360
+        key = (id(surface), size, angle)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        result = pygame.transform.scale(surface, size)
+        if angle:
+            result = rot_center(result, angle)
+        else:
+            result = (result, result.get_rect())
+        image = result[0]
+        cost = image.get_width() * image.get_height() * image.get_bytesize()
+        self._entries[key] = (surface, result, cost)
+        self.used += cost
+        while self.used > self.budget and len(self._entries) > 1:
+            self.used -= self._entries.popitem(last=False)[1][2]
+        return result
+
+    def clear(self):
+        self._entries.clear()
+        self.used = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self.used}
+
+transform_cache = TransformCache()
+
+
+class TextCache:
+    """LRU cache of rendered text keyed on font, text, antialiasing and color.
+
+    Cached surfaces are shared, so callers must not draw on them.
+    """
+
+    def __init__(self, limit=TEXT_CACHE_SIZE):
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def render(self, font: pygame.font.Font, text, antialias, color) -> Surface:
+        key = (font, text, antialias, tuple(color))
+        surface = self._entries.get(key)
+        if surface is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self._entries[key] = font.render(text, antialias, color)
+        while len(self._entries) > self.limit:
+            self._entries.popitem(last=False)
+        return surface
+
+    def render_digits(self, font: pygame.font.Font, text, antialias, color) -> Surface:
+        """Render text with numbers in it, building the numbers from cached
+        digit glyphs so a new number doesn't rasterize the whole string."""
+        parts = [
+            self.render(font, part, antialias, color)
+            for part in re.findall(r'\d|\D+', text)
+        ]
+        result = Surface((
+            sum(part.get_width() for part in parts),
+            max([font.get_height()] + [part.get_height() for part in parts])
+        ), SRCALPHA)
+        x = 0
+        for part in parts:
+            # Text is drawn on transparent black, so max keeps its color and alpha
+            result.blit(part, (x, 0), special_flags=BLEND_RGBA_MAX)
+            x += part.get_width()
+        return result
+
+    def render_fitted(self, font: pygame.font.Font, text, antialias, color, bounds: Rect):
+        """Return render_digits() scaled to fit in bounds and the rect it
+        fills, so showing the same text again doesn't compose or scale it."""
+        key = (font, text, antialias, tuple(color), tuple(bounds))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            rendered = self.render_digits(font, text, antialias, color)
+            rect = rendered.get_rect().fit(bounds)
+            entry = self._entries[key] = (rect, pygame.transform.scale(rendered, rect.size))
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+        return (Rect(entry[0]), entry[1])
+
+text_cache = TextCache()
+# Bumped whenever the display scale changes, invalidating sprite transforms
+transform_epoch = 0
+
+EMPTY_SURFACE = Surface((0, 0))
+OFFSCREEN_RECT = Rect(-1920, -1080, 0, 0)
+
+
 def get_player_animation_rect(x, y):
     return Rect((PLAYER_SLICE[0] * x, PLAYER_SLICE[1] * y), PLAYER_SLICE)
 
 
+_player_animation_frames = {}
+
 def get_player_animation_frame(surface: Surface, direction):
-    return surface.subsurface(
-        get_player_animation_rect(
-            (pygame.time.get_ticks() // PLAYER_ANIMATION_MIN) % PLAYER_ANIMATION_COUNT + 3,
-            direction
-        )
-    )
+    # Frames are reused so the transform cache sees the same surfaces
+    frame = (pygame.time.get_ticks() // PLAYER_ANIMATION_MIN) % PLAYER_ANIMATION_COUNT + 3
+    key = (id(surface), frame, direction)
+    if key not in _player_animation_frames:
+        _player_animation_frames[key] = surface.subsurface(get_player_animation_rect(frame, direction))
+    return _player_animation_frames[key]
 
 
 class AutoSerializedDictionary(dict):
+    """dict that saves itself as JSON on a background thread when changed.
+
+    Changes are coalesced into at most one write every write_interval
+    seconds. Each write goes to a temporary file that then replaces the save
+    file, so a crash can't leave it half written. close() writes anything
+    still pending and is also run at exit.
+
+    Assigning a value equal to the current one is not a change, and content
+    identical to what was last written is not written again. changes,
+    flush_count and bytes_written count what actually happened.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.set_save_path(None)
-        self._flush_interval = 1
+        self.write_interval = SAVE_INTERVAL
+        self._condition = threading.Condition()
+        self._dirty = False
+        self._immediate = False
+        self._closing = False
+        self._last_write = 0
+        self._last_written = None
+        self._writer = None
+        self.changes = 0
+        self.flush_count = 0
+        self.bytes_written = 0
 
     def __setitem__(self, k, v) -> None:
-        super().__setitem__(k, v)
-        self._flush_interval -= 1
-        if self._flush_interval <= 0:
-            self.flush()
-            self._flush_interval = 10
+        if k in self:
+            old = self[k]
+            # type() too, since True == 1
+            if type(old) is type(v) and old == v:
+                return
+        with self._condition:
+            super().__setitem__(k, v)
+            self.changes += 1
+            self._mark_dirty()
+
+    @property
+    def dirty(self):
+        return self._dirty
 
     def set_save_path(self, path):
         self._save_path = path
@@ -126,10 +370,63 @@ class AutoSerializedDictionary(dict):
     def _open_output(self, mode):
         return open(self._save_path, mode)
 
+    def _mark_dirty(self, immediate=False):
+        # Called with self._condition held
+        if self._save_path is None:
+            return
+        self._dirty = True
+        self._immediate = self._immediate or immediate
+        if self._writer is None and not self._closing:
+            self._writer = threading.Thread(target=self._writer_loop, name='save-writer', daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+        self._condition.notify()
+
+    def _take_snapshot(self):
+        # Called with self._condition held
+        self._dirty = self._immediate = False
+        self._last_write = time.monotonic()
+        return dict(self)
+
+    def _write(self, snapshot):
+        text = json.dumps(snapshot)
+        if text == self._last_written:
+            return
+        temp_path = self._save_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as fp:
+                fp.write(text)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp_path, self._save_path)
+        except OSError as e:
+            print(f'Warning: could not write {self._save_path}: {e}')
+        else:
+            self._last_written = text
+            self.flush_count += 1
+            self.bytes_written += len(text)
+
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                while not self._closing:
+                    if self._dirty:
+                        delay = 0 if self._immediate else self._last_write + self.write_interval - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+                if self._closing:
+                    return
+                snapshot = self._take_snapshot()
+            self._write(snapshot)
+
     def flush(self):
-        if self._save_path is not None:
-            with self._open_output('w') as fp:
-                json.dump(self, fp)
+        """Write any changes as soon as possible, without waiting for them."""
+        with self._condition:
+            if self._dirty:
+                self._mark_dirty(immediate=True)
 
     def update_from_file(self):
         if self._save_path is not None:
@@ -138,6 +435,7 @@ class AutoSerializedDictionary(dict):
             with self._open_output('r') as fp:
                 data = json.load(fp)
                 self.update(data)
+                self._last_written = json.dumps(self)
                 return data
 
     @classmethod
@@ -148,33 +446,67 @@ class AutoSerializedDictionary(dict):
         return self
 
     def close(self):
-        self.flush()
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        if self._writer is not None:
+            self._writer.join()
+        with self._condition:
+            snapshot = self._take_snapshot() if self._dirty else None
+        if snapshot is not None:
+            self._write(snapshot)
 
     # def __del__(self):
     #     self.close()
 
-save_game = AutoSerializedDictionary.open('save.json')
-if not save_game:
-    save_game['levels'] = 0
-    save_game['checkpoints'] = 0
-    save_game['death_count'] = 0
-    save_game['game_beat'] = False
-    save_game.flush()
+save_game = AutoSerializedDictionary()
 
 
-def in_range(x, start, stop):
-    return start <= x < stop
+def load_save_data():
+    global save_game
+    save_game = AutoSerializedDictionary.open(None if HEADLESS else 'save.json')
+    if not save_game:
+        save_game['levels'] = 0
+        save_game['checkpoints'] = 0
+        save_game['death_count'] = 0
+        save_game['game_beat'] = False
+        save_game.flush()
 
 
 class Camera:
     def __init__(self):
         self.position = Vector2()
-
-    def update(self, player):
+        # In levels the camera moves once per physics step, since collisions
+        # are found on screen, and is drawn between its last two steps like
+        # the sprites are
+        self.previous_position = Vector2()
+        self.step_position = Vector2()
+        # Whether the last update() left the camera where it was
+        self.converged = False
+
+    def snap(self):
+        # Call after moving the camera directly so the next step starts there
+        self.previous_position.update(self.position)
+        self.step_position.update(self.position)
+
+    def begin_step(self):
+        self.position.update(self.step_position)
+        self.previous_position.update(self.step_position)
+
+    def fixed_update(self, player):
+        self.update(player, fixed_fps_delta)
+        self.step_position.update(self.position)
+
+    def interpolate(self, alpha):
+        self.position.update(self.previous_position.lerp(self.step_position, alpha))
+
+    def update(self, player, delta):
         speed = CAMERA_SPEED
         distance_to_player = self.position.distance_squared_to(player.position)
         if distance_to_player < 1:
+            self.converged = True
             return
+        old_position = tuple(self.position)
         if distance_to_player > 49:
             speed *= 10
         elif distance_to_player > 25:
@@ -187,182 +519,302 @@ class Camera:
         #     speed *= CAMERA_SPEED_2[1]
         #     if distance_to_player > 
         #     print('Updated camera speed:', speed)
-        value = clamp01(speed * delta_time)
+        value = clamp01(speed * delta)
         newpos = self.position.lerp(player.position, value)
         self.position.update(newpos)
         if mode_2d:
             self.position.x = clamp(self.position.x, 6.5, GameStartingItem.current_level.data.size[0] - 6.5)
             self.position.y = clamp(self.position.y, 5, GameStartingItem.current_level.data.size[1] - 6)
             # print(self.position)
+        self.converged = tuple(self.position) == old_position
 
 camera = Camera()
 
 
-def floor_vector(vec: Union[Vector2, Vector3]):
-    return type(vec)([int(part) for part in vec])
+class SpatialIndex:
+    """Uniform grid of PositionBasedSprites keyed by world-space cell.
+
+    Static sprites are placed once; dynamic sprites are moved to their new
+    cells on refresh() when their position has changed cells.
+    """
+
+    def __init__(self, cell_size=8):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.dynamic_sprites = set()
+        self._sprite_cells = {}
+
+    def _cell_range(self, sprite):
+        # Sprites extend right and down (towards -y) from their position,
+        # padded by one unit for rotation
+        sprite_size = sprite.size or 1
+        x, y = sprite.position
+        return (
+            math.floor((x - 1) / self.cell_size),
+            math.floor((y - sprite_size - 1) / self.cell_size),
+            math.floor((x + sprite_size + 1) / self.cell_size),
+            math.floor((y + 1) / self.cell_size),
+        )
+
+    def _link(self, sprite, cell_range):
+        self._sprite_cells[sprite] = cell_range
+        for cx in range(cell_range[0], cell_range[2] + 1):
+            for cy in range(cell_range[1], cell_range[3] + 1):
+                self.cells.setdefault((cx, cy), set()).add(sprite)
+
+    def _unlink(self, sprite):
+        cell_range = self._sprite_cells.pop(sprite)
+        for cx in range(cell_range[0], cell_range[2] + 1):
+            for cy in range(cell_range[1], cell_range[3] + 1):
+                cell = self.cells[cx, cy]
+                cell.discard(sprite)
+                if not cell:
+                    del self.cells[cx, cy]
+
+    def insert(self, sprite):
+        if sprite in self._sprite_cells:
+            return
+        self._link(sprite, self._cell_range(sprite))
+        if sprite.dynamic:
+            self.dynamic_sprites.add(sprite)
+
+    def remove(self, sprite):
+        if sprite in self._sprite_cells:
+            self._unlink(sprite)
+        self.dynamic_sprites.discard(sprite)
+
+    def move(self, sprite):
+        cell_range = self._cell_range(sprite)
+        if cell_range != self._sprite_cells[sprite]:
+            self._unlink(sprite)
+            self._link(sprite, cell_range)
+
+    def refresh(self):
+        for sprite in self.dynamic_sprites:
+            self.move(sprite)
+
+    def query(self, left, bottom, right, top):
+        """Return the sprites in cells overlapping the given world rectangle."""
+        result = set()
+        for cx in range(math.floor(left / self.cell_size), math.floor(right / self.cell_size) + 1):
+            for cy in range(math.floor(bottom / self.cell_size), math.floor(top / self.cell_size) + 1):
+                cell = self.cells.get((cx, cy))
+                if cell:
+                    result.update(cell)
+        return result
+
+
+class CulledGroup(pygame.sprite.Group):
+    """Sprite group that only draws the sprites the camera can see."""
+
+    def __init__(self, *sprites):
+        self.index = SpatialIndex()
+        self._order = {}
+        self._next_order = 0
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self._order[sprite] = self._next_order
+        self._next_order += 1
+        self.index.insert(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        del self._order[sprite]
+        self.index.remove(sprite)
+
+    def visible_sprites(self):
+        self.index.refresh()
+        left = camera.position.x - offset.x
+        bottom = camera.position.y - offset.y
+        visible = self.index.query(
+            left, bottom,
+            left + screen.get_width() / scale, bottom + HEIGHT * scale_direct / scale
+        )
+        return sorted(visible, key=self._order.__getitem__)
+
+    def draw(self, surface, *args, **kwargs):
+        sprites = self.visible_sprites()
+        # Transform stage, then the blits read the cached results
+        for sprite in sprites:
+            sprite._update_transform()
+        self.spritedict.update(zip(sprites, surface.blits(
+            (sprite._image if sprite._on_screen else EMPTY_SURFACE, sprite._rect) for sprite in sprites)))
+        self.lostsprites = []
+        return [rect for rect in self.spritedict.values() if rect]
+
+
+## group all the sprites together for ease of update
+foreground_sprites = CulledGroup()
 
 
 class PositionBasedSprite(pygame.sprite.Sprite):
     base_image: Surface
+    # Dynamic sprites move, so the spatial index re-checks them every frame
+    dynamic = False
+    # Set on PhysicsEnabledSprites, which are drawn interpolated from it
+    previous_position = None
 
     def __init__(self, size=None):
         super().__init__()
         self.position = Vector2()
         self.rotation = 0
         self.size = size
-        self._last_position_pos = [None, None]
-        self._last_position_image = [None, None]
-
-    def _get_image(self):
-        if self._last_position_image[0] == ((self.position, self.rotation), camera.position):
-            return self._last_position_image[1]
-        self._last_position_image[0] = ((Vector2(self.position), self.rotation), Vector2(camera.position))
-        scaled_size = math.floor(self.size * scale)
-        result = pygame.transform.scale(self.base_image, (scaled_size, scaled_size))
-        result = rot_center(result, self.rotation)
-        self._last_position_image[1] = result
-        return result
+        # Screen transform, recomputed by _update_transform() only when the
+        # inputs it was computed from change
+        self._rect = Rect(OFFSCREEN_RECT)
+        self._image = EMPTY_SURFACE
+        self._image_rect = None
+        self._on_screen = False
+        self._transform_epoch = -1
+        self._transform_base = None
+        self._transform_rotation = None
+        self._transform_x = self._transform_y = None
+        self._camera_x = self._camera_y = None
+
+    def _update_transform(self):
+        if (self._transform_epoch != transform_epoch
+                or self.base_image is not self._transform_base
+                or self.rotation != self._transform_rotation):
+            scaled_size = math.floor(self.size * scale)
+            image, self._image_rect = transform_cache.get(self.base_image, (scaled_size, scaled_size), self.rotation)
+            self._image = image
+            self._transform_epoch = transform_epoch
+            self._transform_base = self.base_image
+            self._transform_rotation = self.rotation
+            self._transform_x = None
+        position = self.position
+        x = position.x
+        y = position.y
+        previous = self.previous_position
+        if previous is not None and mode_2d and physics_alpha < 1:
+            # Vector2.lerp, without building a Vector2
+            x = previous.x * (1 - physics_alpha) + x * physics_alpha
+            y = previous.y * (1 - physics_alpha) + y * physics_alpha
+        camera_position = camera.position
+        if (x == self._transform_x and y == self._transform_y
+                and camera_position.x == self._camera_x and camera_position.y == self._camera_y):
+            return
+        self._transform_x = x
+        self._transform_y = y
+        self._camera_x = camera_position.x
+        self._camera_y = camera_position.y
+        self._on_screen = accel.place_rect(
+            self._rect, self._image_rect, x, y, camera_position.x, camera_position.y,
+            offset.x, offset.y, scale, HEIGHT * scale_direct, growness * 4 / 3, growness,
+            self.size <= 1)
+        if not self._on_screen:
+            self._rect.update(OFFSCREEN_RECT)
 
     @property
     def image(self):
-        if self._pos_on_screen() is None:
-            return Surface((0, 0))
-        return self._get_image()[0]
+        self._update_transform()
+        return self._image if self._on_screen else EMPTY_SURFACE
 
     @property
     def radius(self):
         return self.size // 2 * scale
 
-    def _pos_on_screen(self):
-        if self._last_position_pos[0] == (self.position, camera.position):
-            return self._last_position_pos[1]
-        self._last_position_pos[0] = (Vector2(self.position), Vector2(camera.position))
-        base_vector = Vector2(self.position)
-        base_vector += offset
-        base_vector -= camera.position
-        if self.size <= 1 and (
-               base_vector.x < -1
-            or base_vector.y < -1
-            or base_vector.x > growness * 4 / 3 + 1
-            or base_vector.y > growness + 1
-        ):
-            self._last_position_pos[1] = None
-            return None
-        self._last_position_pos[1] = base_vector
-        return base_vector
-
     @property
     def rect(self):
-        # scaled_size = math.floor(self.size * scale)
-        base_vector = self._pos_on_screen()
-        # base_vector = Vector2(self.position)
-        # base_vector += offset
-        # base_vector -= camera.position
-        if base_vector is None:
-            return Rect(-1920, -1080, 0, 0)
-        base_vector = floor_vector(base_vector * scale)
-        base_vector.y = HEIGHT * scale_direct - base_vector.y
-        rect = Rect(self._get_image()[1])
-        rect.x += round(base_vector[0])
-        rect.y += round(base_vector[1])
-        return rect
+        self._update_transform()
+        return self._rect
 
 
 class PhysicsEnabledSprite(PositionBasedSprite):
-    active_sprites = set()
+    # Used as an insertion-ordered set, so sprites step in the same order
+    # every run; the order decides which enemy kills the player first
+    active_sprites = {}
+    dynamic = True
 
     @classmethod
     def global_physics_update(cls):
-        for sprite in cls.active_sprites:
+        sprites = Enemy.simulated_sprites(cls.active_sprites)
+        if BATCHED_PHYSICS and len(sprites) >= BATCHED_PHYSICS_MIN_SPRITES:
+            batched_physics.step(sprites)
+            return
+        for sprite in sprites:
             sprite.physics_update()
 
+    @classmethod
+    def store_previous_positions(cls):
+        for sprite in cls.active_sprites:
+            sprite.previous_position.update(sprite.position)
+
     def __init__(self, size=None):
         super().__init__(size)
         self.vertical_velocity = 0
-        self._collisions = [None] * 5
+        # Position before the last physics step, for interpolated drawing
+        self.previous_position = Vector2()
+        # Where refresh_collisions() last looked for tiles, None before then
+        self._probe_x = self._probe_y = None
         self.grounded = False
         self.activate()
 
     def activate(self):
-        self.active_sprites.add(self)
+        self.active_sprites[self] = None
+        self.snap()
 
     def deactivate(self):
-        self.active_sprites.remove(self)
-
-    def collisions(self):
-        if fixed_fps_passed == 0:
-            self._collisions.clear()
-            level_data = GameStartingItem.current_level.data
-            level_size = level_data.size
-            tiles = level_data.tiles
-            for direction in [
-                (0, 0),
-                (0, 1),
-                (0, -1),
-                (-1, 0),
-                (1, 0)
-            ]:
-                position = (
-                    round(self.position.x + direction[0]),
-                    level_size[1] - round(self.position.y + direction[1])
-                )
-                if in_range(position[0], 0, level_size[0]) \
-                    and in_range(position[1], 0, level_size[1]):
-                    tile = tiles[position[0]][position[1]]
-                    if tile is not None and tile.collidable:
-                        self._collisions.append(tile)
-                    else:
-                        self._collisions.append(None)
-                else:
-                    self._collisions.append(None)
-        return self._collisions
+        del self.active_sprites[self]
+
+    def snap(self):
+        # Call after teleporting so the sprite isn't drawn sliding there
+        self.previous_position.update(self.position)
+
+    def refresh_collisions(self):
+        # Tiles are found around the sprite's position now, then tested
+        # against its rect wherever it is when tile_contacts() is called
+        self._probe_x = self.position.x
+        self._probe_y = self.position.y
+
+    def tile_contacts(self):
+        """Bit mask of the sides, in accel.PROBE_DIRECTIONS order, where a
+        tile found by the last refresh_collisions() overlaps the sprite."""
+        if self._probe_x is None:
+            return 0
+        rect = self.rect
+        camera_position = camera.position
+        return accel.tile_contacts(
+            GameStartingItem.current_level.data.tile_grid, TILE_COLLIDABLE_BYTES,
+            self._probe_x, self._probe_y, rect.x, rect.y, rect.width, rect.height,
+            camera_position.x, camera_position.y, offset.x, offset.y,
+            scale, HEIGHT * scale_direct, growness * 4 / 3, growness)
 
     def is_colliding(self, side):
-        collisions = self.collisions()
-        collision = collisions[side]
-        return collision is not None and self.rect.colliderect(collision.rect)
+        return bool(self.tile_contacts() >> side & 1)
 
     def physics_update(self):
-        collisions = self.collisions()
-        self.grounded = self.is_colliding(2)
-        if not self.grounded:
-            self.vertical_velocity += GRAVITY
-        if self.grounded:
-            self.vertical_velocity = max(0, self.vertical_velocity)
-        if self.is_colliding(1):
-            self.vertical_velocity = min(0, self.vertical_velocity)
+        self.refresh_collisions()
+        contacts = self.tile_contacts()
+        self.grounded = bool(contacts >> 2 & 1)
+        self.vertical_velocity = accel.step_velocity(
+            self.vertical_velocity, self.grounded, contacts >> 1 & 1, GRAVITY)
         self.position.y += self.vertical_velocity
 
 
 class Player(PhysicsEnabledSprite):
-    player_raw_image = pygame.image.load('assets/player.png').convert_alpha()
+    player_raw_image: Surface
 
     def __init__(self):
         super().__init__(1)
         self.base_image = get_player_animation_frame(self.player_raw_image, 0)
         self.animation_time_passed = 0
+        # The cell the level triggers were last looked up for
+        self.trigger_cell = None
+        self.cell_triggers = 0
 
     def update(self, *args, **kwargs):
         # mouse_pos = pygame.mouse.get_pos()
         # mouse_rel = Vector2(mouse_pos) - Vector2(self.rect.center)
         # mouse_direction = -mouse_rel.as_polar()[1] - 90
         # self.rotation = mouse_direction
-        if mode_2d:
-            if self.position.y < 0.5:
-                self.die()
         if movement:
             to_move = movement.normalize()
-            if mode_2d:
-                if to_move.y:
-                    if self.grounded:
-                        self.vertical_velocity = MOVING_JUMP_SPEED if to_move.x else JUMP_SPEED
-                    to_move.y = 0
-            if not self.is_colliding(0):
-                if self.is_colliding(3):
-                    to_move.x = max(0, to_move.x)
-                if self.is_colliding(4):
-                    to_move.x = min(0, to_move.x)
-                self.position += to_move * delta_time * SPEED
+            if not mode_2d:
+                # In levels the move happens in fixed_update()
+                self.move(to_move, delta_time)
             # self.position.update(clamp(self.position.x, -24, 24), clamp(self.position.y, -2, 18))
             if not mode_2d:
                 oldpos = Vector2(self.position)
@@ -388,36 +840,106 @@ class Player(PhysicsEnabledSprite):
                     animation_direction = 2
             self.base_image = get_player_animation_frame(self.player_raw_image,
                                                          animation_direction)
-        if mode_2d:
-            ckpt_position = Vector2(*(int(item) for item in self.position))
-            if ckpt_position in GameStartingItem.current_level.data.checkpoint_positions:
-                save_game['checkpoints'] |= GameStartingItem.current_level.save_bit
-            if self.position.distance_squared_to(GameStartingItem.current_level.data.endpoint) <= 1:
-                GameStartingItem.current_level.exit_level(True)
+
+    def check_level_position(self):
+        # Falls, checkpoints and the goal are checked after every physics
+        # step rather than every frame, like the input in fixed_update()
+        if self.position.y < 0.5:
+            self.die()
+        level = GameStartingItem.current_level
+        cell = (int(self.position.x), int(self.position.y))
+        if cell != self.trigger_cell:
+            # Only look up the triggers when entering a new cell
+            self.trigger_cell = cell
+            self.cell_triggers = level.data.triggers_at(*cell)
+            if self.cell_triggers & (TRIGGER_CHECKPOINT | TRIGGER_RESPAWN):
+                save_game['checkpoints'] |= level.save_bit
+        if self.cell_triggers & TRIGGER_GOAL:
+            if self.position.distance_squared_to(level.data.endpoint) <= 1:
+                level.exit_level(True)
+
+    def move(self, to_move, delta):
+        contacts = self.tile_contacts()
+        if not contacts & 1:
+            if contacts >> 3 & 1:
+                to_move.x = max(0, to_move.x)
+            if contacts >> 4 & 1:
+                to_move.x = min(0, to_move.x)
+            self.position += to_move * delta * SPEED
+
+    def fixed_update(self):
+        # Input is applied once per physics step so levels play the same at
+        # any frame rate
+        if movement:
+            to_move = movement.normalize()
+            if to_move.y:
+                if self.grounded:
+                    self.vertical_velocity = MOVING_JUMP_SPEED if to_move.x else JUMP_SPEED
+                to_move.y = 0
+            self.move(to_move, fixed_fps_delta)
 
     def die(self):
         save_game['death_count'] += 1
         self.position.update(GameStartingItem.current_level.get_spawn())
         self.vertical_velocity = 0
+        self.snap()
         death_counter.rect, death_counter.content = create_death_counter()
 
-player = Player()
+player: Player = None
 
 
 class Enemy(PhysicsEnabledSprite):
-    base_image = pygame.image.load('assets/enemy.png').convert_alpha()
     enemies = []
 
     @classmethod
     def remove_enemies(cls):
         for enemy in cls.enemies:
-            enemy.deactivate()
+            if not enemy.asleep:
+                enemy.deactivate()
+            enemy.asleep = False
             foreground_sprites.remove(enemy)
         cls.enemies.clear()
 
+    @classmethod
+    def simulated_sprites(cls, sprites):
+        """Return the sprites that need a full physics step this tick.
+
+        Enemies only move while on screen, so ones outside the view are held
+        where they are without probing tiles or transforming their image.
+        Those more than ENEMY_ACTIVITY_RADIUS outside it are put to sleep, and
+        sleeping enemies are woken through the spatial index as the camera
+        comes near.
+        """
+        # The view as in CulledGroup.visible_sprites(), padded so that
+        # anything the full step could find on screen still gets it
+        left = camera.position.x - offset.x - 2
+        bottom = camera.position.y - offset.y - 2
+        right = left + screen.get_width() / scale + 4
+        top = bottom + HEIGHT * scale_direct / scale + 4
+        radius = ENEMY_ACTIVITY_RADIUS
+        for sprite in foreground_sprites.index.query(left - radius, bottom - radius,
+                                                     right + radius, top + radius):
+            if getattr(sprite, 'asleep', False) and sprite.distance_outside(left, bottom, right, top) <= radius:
+                sprite.wake()
+        result = []
+        for sprite in list(sprites):
+            if not isinstance(sprite, Enemy):
+                result.append(sprite)
+                continue
+            distance = sprite.distance_outside(left, bottom, right, top)
+            if not distance:
+                result.append(sprite)
+                continue
+            # What the full step leaves an off-screen enemy with
+            sprite.vertical_velocity = 0
+            if distance > radius:
+                sprite.sleep()
+        return result
+
     def __init__(self, position, direction):
         self.original_position = position
         self.original_movement_direction = direction
+        self.asleep = False
         super().__init__(1)
         self.movement_direction = direction
         self.deactivate()
@@ -425,18 +947,41 @@ class Enemy(PhysicsEnabledSprite):
     def reset(self):
         self.position = Vector2(self.original_position)
         self.movement_direction = self.original_movement_direction
+        self.snap()
 
     def activate(self):
         super().activate()
         foreground_sprites.add(self)
+        self.asleep = False
         self.reset()
 
+    def distance_outside(self, left, bottom, right, top):
+        """How far the enemy is outside the given world rectangle, 0 if inside."""
+        (x, y) = self.position
+        return max(left - x, x - right, bottom - y, y - top, 0)
+
+    def sleep(self):
+        self.deactivate()
+        self.asleep = True
+        # Sleeping enemies don't move, so stop re-indexing them every frame
+        foreground_sprites.index.move(self)
+        foreground_sprites.index.dynamic_sprites.discard(self)
+
+    def wake(self):
+        self.asleep = False
+        self.active_sprites[self] = None
+        foreground_sprites.index.dynamic_sprites.add(self)
+        self.snap()
+
     def physics_update(self):
+        previous_y = self.position.y
         super().physics_update()
         if not Rect((0, 0), size).colliderect(self.rect):
-            self.position.y -= self.vertical_velocity
+            # Held exactly where it was, as when simulated_sprites() pauses it
+            self.position.y = previous_y
             self.vertical_velocity = 0
             return
+        self.refresh_collisions()
         collide_direction = 3 + (self.movement_direction > 0)
         if self.is_colliding(collide_direction):
             self.movement_direction *= -1
@@ -452,99 +997,359 @@ class Enemy(PhysicsEnabledSprite):
         return self
 
 
+def _overlap(a, b):
+    """Vectorized Rect.colliderect for (x, y, w, h) tuples of arrays."""
+    return (
+        (a[2] > 0) & (a[3] > 0) & (b[2] > 0) & (b[3] > 0)
+        & (a[0] < b[0] + b[2]) & (b[0] < a[0] + a[2])
+        & (a[1] < b[1] + b[3]) & (b[1] < a[1] + a[3])
+    )
+
+
+class BatchedPhysics:
+    """Runs PhysicsEnabledSprite.physics_update and Enemy.physics_update for
+    all active sprites at once.
+
+    Positions, velocities and directions are gathered into arrays, stepped
+    with the same arithmetic and screen-space rect tests as the per-sprite
+    code, and written back. Sprites of other classes that override
+    physics_update are stepped one at a time.
+
+    Enemies touching the player kill it in the order the per-sprite code
+    steps them, each against the player as it is at that point: before or
+    after its own step, or back at its spawn after an earlier kill.
+    """
+
+    # Probe offsets, in the order of accel.PROBE_DIRECTIONS
+    DIRECTIONS = np.array([(0, 0), (0, 1), (0, -1), (-1, 0), (1, 0)], np.float64)
+
+    def _screen_rects(self, x, y, sizes, image_rects):
+        # Same operation order as accel.place_rect, so the pixels round alike
+        bx = x + (offset.x - camera.position.x)
+        by = y + (offset.y - camera.position.y)
+        culled = (sizes <= 1) & (
+            (bx < -1) | (by < -1) | (bx > growness * 4 / 3 + 1) | (by > growness + 1))
+        visible = ~culled
+        return (
+            image_rects[0] + np.trunc(bx * scale),
+            image_rects[1] + np.round(HEIGHT * scale_direct - np.trunc(by * scale)),
+            np.where(visible, image_rects[2], 0),
+            np.where(visible, image_rects[3], 0),
+        )
+
+    def _image_groups(self, sprites):
+        groups = {}
+        for (i, sprite) in enumerate(sprites):
+            groups.setdefault((id(sprite.base_image), sprite.size), (sprite.base_image, []))[1].append(i)
+        return [(base_image, sprite_size, np.array(indices))
+                for ((_, sprite_size), (base_image, indices)) in groups.items()]
+
+    def _image_rects(self, groups, count, rotations):
+        """Rects of the transformed images, looked up once per base image and rotation."""
+        rects = np.zeros((4, count))
+        for (base_image, sprite_size, indices) in groups:
+            scaled_size = math.floor(sprite_size * scale)
+            angles = np.mod(np.round(rotations[indices] / TRANSFORM_ANGLE_STEP) * TRANSFORM_ANGLE_STEP, 360)
+            unique_angles, inverse = np.unique(angles, return_inverse=True)
+            table = np.array([
+                tuple(transform_cache.get(base_image, (scaled_size, scaled_size), angle)[1])
+                for angle in unique_angles.tolist()
+            ], np.float64).reshape(-1, 4)
+            rects[:, indices] = table[inverse.reshape(-1)].T
+        return rects
+
+    def _probe(self, level_data, x, y):
+        """Tiles around each body, as in accel.tile_contacts()."""
+        (width, height) = level_data.size
+        tile_x = np.round(x[:, None] + self.DIRECTIONS[:, 0]).astype(np.int64)
+        tile_y = np.round(y[:, None] + self.DIRECTIONS[:, 1]).astype(np.int64)
+        map_y = height - tile_y
+        inside = (tile_x >= 0) & (tile_x < width) & (map_y >= 0) & (map_y < height)
+        ids = np.zeros(tile_x.shape, np.uint8)
+        ids[inside] = level_data.tile_grid[tile_x[inside], map_y[inside]]
+        solid = inside & TILE_COLLIDABLE[ids]
+        tile_size = math.floor(scale)
+        tile_rects = self._screen_rects(
+            tile_x.astype(np.float64), tile_y.astype(np.float64),
+            np.ones(tile_x.shape), (0, 0, tile_size, tile_size))
+        return (tile_x, map_y, solid, tile_rects)
+
+    def _colliding(self, probes, rects, side):
+        (_, _, solid, tile_rects) = probes
+        return solid[:, side] & _overlap(rects, tuple(part[:, side] for part in tile_rects))
+
+    def step(self, active_sprites):
+        base_step = PhysicsEnabledSprite.physics_update
+        bodies = []
+        for sprite in active_sprites:
+            method = type(sprite).physics_update
+            if method is base_step or method is Enemy.physics_update:
+                bodies.append(sprite)
+            else:
+                sprite.physics_update()
+        if not bodies:
+            return
+
+        level_data = GameStartingItem.current_level.data
+        x = np.array([sprite.position.x for sprite in bodies], np.float64)
+        y = np.array([sprite.position.y for sprite in bodies], np.float64)
+        velocity = np.array([sprite.vertical_velocity for sprite in bodies], np.float64)
+        rotation = np.array([sprite.rotation for sprite in bodies], np.float64)
+        sizes = np.array([sprite.size for sprite in bodies], np.float64)
+        is_enemy = np.array([type(sprite).physics_update is Enemy.physics_update for sprite in bodies])
+        direction = np.array([getattr(sprite, 'movement_direction', 0) for sprite in bodies], np.float64)
+        image_groups = self._image_groups(bodies)
+        image_rects = self._image_rects(image_groups, len(bodies), rotation)
+
+        # PhysicsEnabledSprite.physics_update
+        probes = self._probe(level_data, x, y)
+        rects = self._screen_rects(x, y, sizes, image_rects)
+        grounded = self._colliding(probes, rects, 2)
+        velocity = np.where(grounded, np.maximum(0, velocity), velocity + GRAVITY)
+        velocity = np.where(self._colliding(probes, rects, 1), np.minimum(0, velocity), velocity)
+        previous_y = y
+        y = y + velocity
+
+        # Enemy.physics_update
+        rects = self._screen_rects(x, y, sizes, image_rects)
+        screen_rect = (np.zeros(1), np.zeros(1), np.full(1, size[0]), np.full(1, size[1]))
+        off_screen = is_enemy & ~_overlap(screen_rect, rects)
+        y = np.where(off_screen, previous_y, y)
+        velocity = np.where(off_screen, 0, velocity)
+        moving = is_enemy & ~off_screen
+        # Enemies that moved look at the tiles around their new position
+        moved_probes = self._probe(level_data, x, y)
+        wall = np.where(direction > 0, self._colliding(moved_probes, rects, 4),
+                        self._colliding(moved_probes, rects, 3))
+        direction = np.where(moving & wall, -direction, direction)
+        rotation = np.where(moving, np.mod(rotation + 90 * fixed_fps_delta * direction * -1, 360), rotation)
+        x = np.where(moving, x + direction * fixed_fps_delta, x)
+        rects = self._screen_rects(x, y, sizes, self._image_rects(image_groups, len(bodies), rotation))
+
+        player_index = None
+        for (i, sprite) in enumerate(bodies):
+            if sprite is player:
+                player_index = i
+                continue
+            if is_enemy[i]:
+                sprite.movement_direction = int(direction[i])
+                sprite.rotation = float(rotation[i])
+            else:
+                sprite.refresh_collisions()
+            sprite.position.update(x[i], y[i])
+            sprite.vertical_velocity = float(velocity[i])
+            sprite.grounded = bool(grounded[i])
+
+        start = 0
+        player_died = False
+        while start < len(bodies):
+            end = player_index if player_index is not None and player_index >= start else len(bodies)
+            if moving[start:end].any():
+                player_rect = tuple(np.array([value], np.float64) for value in player.rect)
+                hits = np.nonzero(moving[start:end] & _overlap(
+                    tuple(part[start:end] for part in rects), player_rect))[0]
+                if len(hits):
+                    player.die()
+                    player_died = True
+                    start += hits[0] + 1
+                    continue
+            if end == len(bodies):
+                break
+            if player_died:
+                # The player steps from its spawn, not where it was gathered
+                PhysicsEnabledSprite.physics_update(player)
+            else:
+                player.refresh_collisions()
+                player.position.update(x[end], y[end])
+                player.vertical_velocity = float(velocity[end])
+                player.grounded = bool(grounded[end])
+            start = end + 1
+
+        for i in np.nonzero(moving & (y < 0.5))[0]:
+            bodies[i].reset()
+
+batched_physics = BatchedPhysics()
+
+
 map_point = (-40, 32)
 map_size = (80, 56)
 water_size = 8
 total_size = (map_size[0], map_size[1] + water_size)
 
-if os.path.exists('cache'):
-    bg_image = pygame.image.load('cache/bigmap.png')
 
-else:
-    os.mkdir('cache')
-
-    sand_base = pygame.image.load('assets/sand.png')
-    water_base = pygame.image.load('assets/water.png')
-    bg_image = Surface((total_size[0] * 16, total_size[1] * 16))
-    sand = []
-    water = []
-    for r in range(4):
-        sand.append(pygame.transform.rotate(sand_base, 90 * r))
-        water.append(pygame.transform.rotate(water_base, 90 * r))
-    for x in range(map_size[0]):
-        for y in range(map_size[1]):
-            rect = Rect(x * 16, y * 16, 16, 16)
-            bg_image.blit(random.choice(sand), rect)
-    for x in range(map_size[0]):
-        for y in range(water_size):
-            rect = Rect(x * 16, (y + map_size[1]) * 16, 16, 16)
-            bg_image.blit(random.choice(water), rect)
-    pygame.image.save(bg_image, 'cache/bigmap.png')
+
+# Overworld generation is reproducible for a given seed
+MAP_SEED = 0
+MAP_TILE_SIZE = 16
+MAP_CACHE_VERSION = 1
+MAP_ASSETS = ('assets/sand.png', 'assets/water.png')
+
+
+def _map_cache_path(seed):
+    digest = hashlib.sha1(repr((MAP_CACHE_VERSION, seed, map_size, water_size, MAP_TILE_SIZE)).encode())
+    for path in MAP_ASSETS:
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    return f'cache/bigmap-{digest.hexdigest()[:16]}.png'
+
+
+def generate_map_background(seed=MAP_SEED) -> Surface:
+    """Build the overworld from randomly rotated sand and water tiles."""
+    # The four rotations of each tile, sand then water
+    variants = [
+        pygame.transform.rotate(pygame.image.load(path), 90 * r).convert()
+        for path in MAP_ASSETS
+        for r in range(4)
+    ]
+    # Which variant goes in each cell, sand above and water below
+    rng = np.random.default_rng(seed)
+    cells = np.empty(total_size, np.intp)
+    cells[:, :map_size[1]] = rng.integers(0, 4, map_size)
+    cells[:, map_size[1]:] = 4 + rng.integers(0, 4, (map_size[0], water_size))
+    (xs, ys) = np.indices(total_size) * MAP_TILE_SIZE
+    bg_image = Surface((total_size[0] * MAP_TILE_SIZE, total_size[1] * MAP_TILE_SIZE)).convert()
+    bg_image.blits(zip(
+        [variants[cell] for cell in cells.ravel().tolist()],
+        zip(xs.ravel().tolist(), ys.ravel().tolist())
+    ), doreturn=False)
+    return bg_image
+
+
+def _save_map_background(bg_image, path):
+    # Only one generated map is kept
+    for old in glob.glob('cache/bigmap*.png'):
+        if old != path:
+            os.remove(old)
+    temp_path = path + '.tmp.png'
+    pygame.image.save(bg_image, temp_path)
+    os.replace(temp_path, path)
+
+
+def load_map_background(seed=MAP_SEED):
+    path = _map_cache_path(seed)
+    if os.path.exists(path):
+        return pygame.image.load(path)
+    os.makedirs('cache', exist_ok=True)
+    bg_image = generate_map_background(seed)
+    # Writing the PNG is slower than generating it, keep it off startup
+    asset_loader.submit(_save_map_background, bg_image.copy(), path)
+    return bg_image
 
 
 class Background(PositionBasedSprite):
-    base_image = bg_image
     position = Vector2(map_point)
 
 
 class StandalonePositionBasedRenderer:
+    # Map pixels shown across the screen
+    VIEW_SIZE = (160, 120)
+
     def __init__(self, surface: Surface, position: Vector2):
         self.surface = surface
         # self.resize(scale)
-        self.position = position
-        self._last_position = [None, None]
+        self.position = Vector2(position)
+        # Scaled tiles of the surface, (tile x, tile y) -> (surface, rect)
+        self._tiles = OrderedDict()
+        self._tiles_used = 0
+        self._tiles_epoch = None
 
     def resize(self, scale):
         self.surface = pygame.transform.scale(self.surface,
             [round(x * scale) for x in self.surface.get_size()])
 
-    def _pos_on_screen(self):
-        if self._last_position[0] == (self.position, camera.position):
-            return self._last_position[1]
-        self._last_position[0] = (Vector2(self.position), Vector2(camera.position))
-        base_vector = Vector2(self.position)
-        base_vector += offset
-        base_vector -= camera.position
-        self._last_position[1] = base_vector
-        return base_vector
-
     def _pos_in_screen(self):
-        rel_pos = self._pos_on_screen()
-        base_vector = floor_vector(rel_pos * scale)
-        base_vector.y = HEIGHT * scale_direct - base_vector.y
-        return base_vector * -1
+        return Vector2(accel.view_origin(
+            self.position.x, self.position.y, camera.position.x, camera.position.y,
+            offset.x, offset.y, scale, HEIGHT * scale_direct))
+
+    def _scale_factor(self):
+        return (size[0] / self.VIEW_SIZE[0], size[1] / self.VIEW_SIZE[1])
+
+    def _tile(self, tile_x, tile_y):
+        """The tile scaled to the screen and its rect on the whole scaled surface."""
+        if self._tiles_epoch != transform_epoch:
+            self._tiles.clear()
+            self._tiles_used = 0
+            self._tiles_epoch = transform_epoch
+        key = (tile_x, tile_y)
+        entry = self._tiles.get(key)
+        if entry is not None:
+            self._tiles.move_to_end(key)
+            return entry
+        (scale_x, scale_y) = self._scale_factor()
+        source = Rect(tile_x * BACKGROUND_TILE_SIZE, tile_y * BACKGROUND_TILE_SIZE,
+                      BACKGROUND_TILE_SIZE, BACKGROUND_TILE_SIZE).clip(self.surface.get_rect())
+        left = round(source.left * scale_x)
+        top = round(source.top * scale_y)
+        rect = Rect(left, top, round(source.right * scale_x) - left, round(source.bottom * scale_y) - top)
+        image = pygame.transform.scale(self.surface.subsurface(source), rect.size).convert()
+        entry = (image, rect)
+        self._tiles[key] = entry
+        self._tiles_used += rect.width * rect.height * image.get_bytesize()
+        while self._tiles_used > BACKGROUND_CACHE_BUDGET and len(self._tiles) > 1:
+            (old, old_rect) = self._tiles.popitem(last=False)[1]
+            self._tiles_used -= old_rect.width * old_rect.height * old.get_bytesize()
+        return entry
 
     def draw(self, on: Surface):
         base_vector = self._pos_in_screen()
         # base_vector = floor_vector(base_vector * scale)
         # base_vector.y = HEIGHT * scale_direct - base_vector.y
-        subrect = Rect(base_vector // 4, (160, 120))
-        if self.surface.get_rect().colliderect(subrect):
-            try:
-                surf = self.surface.subsurface(subrect)
-            except ValueError as e:
-                print('Error occured in rendering', self, 'on', on, '\n  ', e)
-                return
-            # print(tuple(int(x) for x in Vector2(size) * 16))
-            surf = pygame.transform.scale(surf, size)
-            rect = Rect((0, 0), size)
-            on.blit(surf, rect)
-
-
-level_font = pygame.font.SysFont('calibri', 20)
+        subrect = Rect(base_vector // 4, self.VIEW_SIZE)
+        surface_rect = self.surface.get_rect()
+        if not surface_rect.colliderect(subrect):
+            return
+        if not surface_rect.contains(subrect):
+            # Past the edge of the map
+            on.fill(BLACK)
+        # Blit the pre-scaled tiles under the view, skipping any outside the clip
+        (scale_x, scale_y) = self._scale_factor()
+        origin = (round(subrect.x * scale_x), round(subrect.y * scale_y))
+        clip = on.get_clip()
+        visible = subrect.clip(surface_rect)
+        blits = []
+        for tile_y in range(visible.top // BACKGROUND_TILE_SIZE, (visible.bottom - 1) // BACKGROUND_TILE_SIZE + 1):
+            for tile_x in range(visible.left // BACKGROUND_TILE_SIZE, (visible.right - 1) // BACKGROUND_TILE_SIZE + 1):
+                tile_rect = Rect(tile_x * BACKGROUND_TILE_SIZE, tile_y * BACKGROUND_TILE_SIZE,
+                                 BACKGROUND_TILE_SIZE, BACKGROUND_TILE_SIZE)
+                screen_rect = Rect(
+                    round(tile_rect.x * scale_x) - origin[0], round(tile_rect.y * scale_y) - origin[1],
+                    math.ceil(tile_rect.width * scale_x), math.ceil(tile_rect.height * scale_y))
+                if not screen_rect.colliderect(clip):
+                    continue
+                (image, rect) = self._tile(tile_x, tile_y)
+                blits.append((image, (rect.x - origin[0], rect.y - origin[1])))
+        on.blits(blits, doreturn=False)
+
+
+background: StandalonePositionBasedRenderer = None
+
+level_font: pygame.font.Font = None
 
 
 class Tile(PositionBasedSprite):
-    base_image: Union[str, Surface]
+    # A path or None until get_base_image() is first called
+    base_image: Union[str, Surface, None]
     friction: float
     collidable: bool = True
+    # Overlay tiles are drawn above the player and enemies
+    overlay: bool = False
 
     def __new__(cls, *args):
         self = PositionBasedSprite.__new__(cls)
-        if not isinstance(cls.base_image, Surface):
-            cls.base_image = pygame.image.load(cls.base_image)
+        cls.get_base_image()
         return self
 
+    @classmethod
+    def get_base_image(cls) -> Surface:
+        if not isinstance(cls.base_image, Surface):
+            cls.base_image = cls.create_base_image()
+        return cls.base_image
+
+    @classmethod
+    def create_base_image(cls) -> Surface:
+        return pygame.image.load(cls.base_image)
+
     def __init__(self, pos, level):
         super().__init__(1)
         self.position.update(pos)
@@ -578,21 +1383,70 @@ class WallTile(Tile):
 
 
 class GoalTile(Tile):
-    base_image = Surface((16, 16)).convert_alpha()
-    base_image.fill((0, 255, 0, 128))
+    base_image = None
     collidable = False
+    overlay = True
+
+    @classmethod
+    def create_base_image(cls):
+        image = Surface((16, 16)).convert_alpha()
+        image.fill((0, 255, 0, 128))
+        return image
 
 
 class PinkTile(Tile):
-    base_image = Surface((16, 16)).convert_alpha()
-    base_image.fill((255, 128, 128, 106))
+    base_image = None
     collidable = False
+    overlay = True
+
+    @classmethod
+    def create_base_image(cls):
+        image = Surface((16, 16)).convert_alpha()
+        image.fill((255, 128, 128, 106))
+        return image
 
 
 class WaterTile(Tile):
-    base_image = pygame.image.load('assets/water.png').convert()
-    base_image.set_alpha(96)
+    base_image = None
     collidable = False
+    overlay = True
+
+    @classmethod
+    def create_base_image(cls):
+        image = pygame.image.load('assets/water.png').convert()
+        image.set_alpha(96)
+        return image
+
+
+TILE_CLASSES = {
+    TileTypes.Pink: PinkTile,
+    TileTypes.Water: WaterTile,
+    TileTypes.Goal: GoalTile,
+    TileTypes.Ground: GroundTile,
+    TileTypes.Wall: WallTile,
+}
+# Tile ids used in LevelData.tile_grid, 0 is air
+TILE_CLASSES_BY_ID = [None, *TILE_CLASSES.values()]
+TILE_COLLIDABLE = np.array([False] + [cls.collidable for cls in TILE_CLASSES.values()])
+TILE_FRICTION = np.array([0.0] + [getattr(cls, 'friction', 0.0) for cls in TILE_CLASSES.values()])
+TILE_OVERLAY = np.array([False] + [cls.overlay for cls in TILE_CLASSES.values()])
+# For the compiled collision probe, which takes bytes rather than bools
+TILE_COLLIDABLE_BYTES = TILE_COLLIDABLE.view(np.uint8)
+# Map pixel colors, and the tile id for each as classified by
+# accel.classify_pixels() (kind 0 is an unknown color)
+MAP_COLORS = np.array([tile_type.value for tile_type in TileTypes], np.uint32)
+TILE_ID_BY_KIND = np.array([0] + [
+    list(TILE_CLASSES).index(tile_type) + 1 if tile_type in TILE_CLASSES else 0
+    for tile_type in TileTypes
+], np.uint8)
+
+# Bit flags in LevelData.triggers
+TRIGGER_CHECKPOINT = 1
+TRIGGER_RESPAWN = 2
+# Cells where the player may be within reach of the goal
+TRIGGER_GOAL = 4
+# Hazard cells, not acted on yet
+TRIGGER_WATER = 8
 
 
 class EnemyPlaceholder:
@@ -604,12 +1458,38 @@ class EnemyPlaceholder:
         return Enemy(self.position, self.direction)
 
 
+# Bump when the decoded level format changes so stale caches are rebuilt
+LEVEL_CACHE_VERSION = 3
+LEVELS_ROOT = 'levels'
+
+
+def discover_levels(root=LEVELS_ROOT):
+    """Return the level.json metadata of each levelN directory under root, in order.
+
+    Levels are numbered from 0 and must be contiguous, anything after a gap
+    is skipped. Maps are not loaded.
+    """
+    numbers = sorted(
+        int(entry.name[5:]) for entry in os.scandir(root)
+        if entry.is_dir() and entry.name.startswith('level') and entry.name[5:].isdigit()
+    )
+    index = []
+    for (expected, number) in enumerate(numbers):
+        meta_path = os.path.join(root, f'level{number}', 'level.json')
+        if number != expected or not os.path.isfile(meta_path):
+            print(f'Warning: level{expected} is missing, levels from level{number} on are skipped.')
+            break
+        with open(meta_path) as fp:
+            index.append(json.load(fp))
+    return index
+
+
 class LevelData:
-    __slots__ = ['final_level', 'song_path', 'checkpoint_positions', 'enemies', 'number', '_surf', 'root', 'success', 'meta', 'size', 'tiles', 'bgpath', 'bgrect', 'startpoint', 'endpoint', 'checkpoint', 'verts', 'shape']
+    __slots__ = ['final_level', 'song_path', 'checkpoint_positions', 'enemies', 'number', '_surf', 'root', 'success', 'meta', 'size', 'tile_grid', 'triggers', 'bgpath', 'bgrect', 'startpoint', 'endpoint', 'checkpoint', 'verts', 'shape']
 
-    def __init__(self, number):
+    def __init__(self, number, use_cache=True):
         self.number = number
-        self.root = f'levels/level{number}'
+        self.root = os.path.join(LEVELS_ROOT, f'level{number}')
         self._init_attrs()
         if not os.path.isdir(self.root):
             print(f'Warning: "{self.root}" does not exist or is not a directory. Level skipped.')
@@ -618,7 +1498,11 @@ class LevelData:
             with open(self._get_file_path('level.json')) as fp:
                 self.meta = json.load(fp)
             self.final_level = 'final_level' in self.meta and self.meta['final_level']
-            self._load_level()
+            if not (use_cache and self._load_cache()):
+                self._load_level()
+                if use_cache:
+                    self._save_cache()
+            self._build_triggers()
             # self.background = pygame.image.load(self._get_file_path('background.jpg'))
             self.bgpath = self._get_file_path('background.png')
             bgmeta = self.meta['background']
@@ -634,7 +1518,8 @@ class LevelData:
     def _init_attrs(self):
         self.meta = {}
         self.size = (0, 0)
-        self.tiles = []
+        self.tile_grid = np.zeros((0, 0), np.uint8)
+        self.triggers = np.zeros((0, 0), np.uint8)
         self.bgpath = ''
         self.bgrect = Rect(0, 0, 0, 0)
         self.song_path = ''
@@ -652,73 +1537,306 @@ class LevelData:
         del level_map_image
         self.size = self._surf.shape
         height = self.size[1]
-        for x in range(self.size[0]):
-            row = []
-            self.tiles.append(row)
-            for y in range(height):
-                pixel = self._surf[x, y]
-                position = Vector2(x, height - y)
-                tile = None
-                # Air
-                if pixel == TileTypes.Air.value:
-                    pass
-                elif pixel == TileTypes.Pink.value:
-                    tile = PinkTile(position, self)
-                elif pixel == TileTypes.Water.value:
-                    tile = WaterTile(position, self)
-                # Control
-                elif pixel == TileTypes.Spawn.value:
-                    self.startpoint = position
-                elif pixel == TileTypes.CheckpointRespawn.value:
-                    self.checkpoint = position
-                    self.checkpoint_positions.append(Vector2(position))
-                elif pixel == TileTypes.Checkpoint.value:
-                    self.checkpoint_positions.append(Vector2(position))
-                elif pixel == TileTypes.Goal.value:
-                    tile = GoalTile(position, self)
-                    self.endpoint = position
-                # Collidable
-                elif pixel == TileTypes.Ground.value:
-                    tile = GroundTile(position, self)
-                elif pixel == TileTypes.Wall.value:
-                    tile = WallTile(position, self)
-                # Enemies
-                elif pixel == TileTypes.EnemyLeft.value:
-                    enemy = EnemyPlaceholder(position, -1)
-                    self.enemies.append(enemy)
-                elif pixel == TileTypes.EnemyRight.value:
-                    enemy = EnemyPlaceholder(position, 1)
-                    self.enemies.append(enemy)
-                # Else
-                else:
-                    print(f'Unknown color in {map_path}({x},{y}): {hex(pixel)} Skipping tile.')
-                row.append(tile)
+        kinds = accel.classify_pixels(self._surf.view(np.uint32), MAP_COLORS)
+        kind_of = {tile_type: kind for (kind, tile_type) in enumerate(TileTypes, 1)}
+        # Else
+        for (x, y) in zip(*np.nonzero(kinds == 0)):
+            print(f'Unknown color in {map_path}({x},{y}): {hex(self._surf[x, y])} Skipping tile.')
+
+        def positions(mask):
+            return [Vector2(x, height - y) for (x, y) in zip(*np.nonzero(mask))]
+
+        masks = {tile_type: kinds == kind_of[tile_type] for tile_type in (
+            TileTypes.Spawn, TileTypes.CheckpointRespawn, TileTypes.Checkpoint,
+            TileTypes.Goal, TileTypes.EnemyLeft, TileTypes.EnemyRight)}
+        # Tiles
+        self.tile_grid = TILE_ID_BY_KIND[kinds]
+        # Control
+        # The last matching pixel wins, as with a per-pixel scan
+        self.startpoint = (positions(masks[TileTypes.Spawn]) or [self.startpoint])[-1]
+        self.checkpoint = (positions(masks[TileTypes.CheckpointRespawn]) or [self.checkpoint])[-1]
+        self.checkpoint_positions.extend(positions(
+            masks[TileTypes.CheckpointRespawn] | masks[TileTypes.Checkpoint]))
+        self.endpoint = (positions(masks[TileTypes.Goal]) or [self.endpoint])[-1]
+        # Enemies
+        enemy_left = masks[TileTypes.EnemyLeft]
+        for (x, y) in zip(*np.nonzero(enemy_left | masks[TileTypes.EnemyRight])):
+            direction = -1 if enemy_left[x, y] else 1
+            self.enemies.append(EnemyPlaceholder(Vector2(x, height - y), direction))
         del self._surf
 
-    def iter_tiles(self):
-        return (tile for row in self.tiles for tile in row if tile is not None)
+    def _build_triggers(self):
+        """Build the grid of TRIGGER_* flags for each world cell.
+
+        Unlike tile_grid it is indexed by world position, [x, y] being the
+        cell the player is in at (int(x), int(y)).
+        """
+        (width, height) = self.size
+        self.triggers = np.zeros((width, height + 1), np.uint8)
+
+        def mark(position, flag):
+            (x, y) = (int(position[0]), int(position[1]))
+            if 0 <= x < width and 0 <= y <= height:
+                self.triggers[x, y] |= flag
+
+        for position in self.checkpoint_positions:
+            mark(position, TRIGGER_CHECKPOINT)
+        if self.checkpoint in self.checkpoint_positions:
+            mark(self.checkpoint, TRIGGER_RESPAWN)
+        # The goal is reached within a distance of 1 of the endpoint
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                mark((self.endpoint.x + dx, self.endpoint.y + dy), TRIGGER_GOAL)
+        water_id = list(TILE_CLASSES).index(TileTypes.Water) + 1
+        (water_x, water_y) = np.nonzero(self.tile_grid == water_id)
+        self.triggers[water_x, height - water_y] |= TRIGGER_WATER
+
+    def triggers_at(self, x, y):
+        """TRIGGER_* flags for the cell at world position (x, y)."""
+        (x, y) = (int(x), int(y))
+        if 0 <= x < self.triggers.shape[0] and 0 <= y < self.triggers.shape[1]:
+            return int(self.triggers[x, y])
+        return 0
+
+    def _cache_path(self):
+        return f'cache/level{self.number}.npz'
+
+    def _cache_key(self):
+        digest = hashlib.sha1(str(LEVEL_CACHE_VERSION).encode())
+        for file in ('map.png', 'level.json'):
+            with open(self._get_file_path(file), 'rb') as fp:
+                digest.update(fp.read())
+        return digest.hexdigest()
+
+    def _load_cache(self):
+        """Load the decoded map from the cache, returning False if it is missing or stale."""
+        try:
+            with np.load(self._cache_path(), allow_pickle=False) as cached:
+                if int(cached['version']) != LEVEL_CACHE_VERSION or str(cached['key']) != self._cache_key():
+                    return False
+                tile_grid = cached['tile_grid']
+                startpoint, endpoint, checkpoint = cached['points']
+                checkpoint_positions = cached['checkpoint_positions']
+                enemies = cached['enemies']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return False
+        if (tile_grid.dtype != np.uint8 or tile_grid.ndim != 2
+                or tile_grid.size and tile_grid.max() >= len(TILE_CLASSES_BY_ID)):
+            print(f'Warning: invalid level cache {self._cache_path()}, rebuilding.')
+            return False
+        self.tile_grid = tile_grid
+        self.size = tuple(int(x) for x in tile_grid.shape)
+        self.startpoint = Vector2(*startpoint)
+        self.endpoint = Vector2(*endpoint)
+        self.checkpoint = Vector2(*checkpoint)
+        self.checkpoint_positions = [Vector2(*position) for position in checkpoint_positions]
+        self.enemies = [EnemyPlaceholder(Vector2(x, y), int(direction)) for (x, y, direction) in enemies]
+        return True
+
+    def _save_cache(self):
+        path = self._cache_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as fp:
+            np.savez(
+                fp,
+                version=LEVEL_CACHE_VERSION,
+                key=self._cache_key(),
+                tile_grid=self.tile_grid,
+                points=np.array([self.startpoint, self.endpoint, self.checkpoint], np.float64),
+                checkpoint_positions=np.array(self.checkpoint_positions, np.float64).reshape(-1, 2),
+                enemies=np.array([(*enemy.position, enemy.direction) for enemy in self.enemies],
+                                 np.float64).reshape(-1, 3),
+            )
+        os.replace(temp_path, path)
+
+
+CHUNK_SIZE = 16
+
+
+class TileMapLayer:
+    """Draws the static tiles of a level from pre-rendered chunk surfaces.
+
+    Chunks are CHUNK_SIZE x CHUNK_SIZE tiles, rendered on first use at the
+    current scale, and only the chunks in view are blitted each frame. The
+    least recently drawn chunks are dropped past CHUNK_CACHE_BUDGET bytes.
+    """
+
+    def __init__(self, level_data: LevelData, overlay=False):
+        self.level_data = level_data
+        self.tile_filter = TILE_OVERLAY if overlay else ~TILE_OVERLAY
+        # (chunk x, chunk y) -> (surface or None if empty, frame last drawn)
+        self.chunks = OrderedDict()
+        self._chunks_used = 0
+        self._frame = 0
+        self._tile_images = {}
+        self._scale = None
+
+    def _get_tile_image(self, tile_id):
+        image = self._tile_images.get(tile_id)
+        if image is None:
+            tile_size = math.floor(scale)
+            base_image = TILE_CLASSES_BY_ID[tile_id].get_base_image()
+            image = pygame.transform.scale(base_image, (tile_size, tile_size)).convert_alpha()
+            if base_image.get_masks()[3] == 0 and base_image.get_alpha() is not None:
+                # Chunks have per-pixel alpha, so surface alpha has to be baked in
+                image.set_alpha(None)
+                pygame.surfarray.pixels_alpha(image)[...] = base_image.get_alpha()
+            self._tile_images[tile_id] = image
+        return image
+
+    def _render_chunk(self, cx, cy):
+        x0, y0 = cx * CHUNK_SIZE, cy * CHUNK_SIZE
+        ids = self.level_data.tile_grid[x0:x0 + CHUNK_SIZE, y0:y0 + CHUNK_SIZE]
+        visible = self.tile_filter[ids] & (ids != 0)
+        if not visible.any():
+            return None
+        chunk_size = math.floor(CHUNK_SIZE * scale) + 1
+        chunk = Surface((chunk_size, chunk_size), SRCALPHA).convert_alpha()
+        for (x, y) in zip(*np.nonzero(visible)):
+            chunk.blit(self._get_tile_image(ids[x, y]), (math.floor(x * scale), math.floor(y * scale)))
+        return chunk
+
+    def _get_chunk(self, cx, cy):
+        if self._scale != scale:
+            self.chunks.clear()
+            self._chunks_used = 0
+            self._tile_images.clear()
+            self._scale = scale
+        key = (cx, cy)
+        entry = self.chunks.get(key)
+        if entry is not None:
+            self.chunks[key] = (entry[0], self._frame)
+            self.chunks.move_to_end(key)
+            return entry[0]
+        chunk = self._render_chunk(cx, cy)
+        self.chunks[key] = (chunk, self._frame)
+        if chunk is not None:
+            self._chunks_used += chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        while self._chunks_used > CHUNK_CACHE_BUDGET:
+            (old, frame) = next(iter(self.chunks.values()))
+            if frame == self._frame:
+                break
+            self.chunks.popitem(last=False)
+            if old is not None:
+                self._chunks_used -= old.get_width() * old.get_height() * old.get_bytesize()
+        return chunk
+
+    def draw(self, surface: Surface):
+        width, height = self.level_data.size
+        screen_height = HEIGHT * scale_direct
+        # Map pixel (x, y) is drawn at world position (x, height - y)
+        left = camera.position.x - offset.x
+        top = height - (camera.position.y - offset.y + screen_height / scale)
+        first_cx = max(0, math.floor(left / CHUNK_SIZE))
+        last_cx = min((width - 1) // CHUNK_SIZE, math.floor((left + surface.get_width() / scale) / CHUNK_SIZE))
+        first_cy = max(0, math.floor(top / CHUNK_SIZE))
+        last_cy = min((height - 1) // CHUNK_SIZE, math.floor((top + screen_height / scale) / CHUNK_SIZE))
+        self._frame += 1
+        for cx in range(first_cx, last_cx + 1):
+            screen_x = math.floor((cx * CHUNK_SIZE + offset.x - camera.position.x) * scale)
+            for cy in range(first_cy, last_cy + 1):
+                chunk = self._get_chunk(cx, cy)
+                if chunk is None:
+                    continue
+                world_y = height - cy * CHUNK_SIZE
+                screen_y = screen_height - math.floor((world_y + offset.y - camera.position.y) * scale)
+                surface.blit(chunk, (screen_x, screen_y))
+
+
+# Levels closer than this to the player on the map are loaded ahead of time
+LEVEL_PREFETCH_DISTANCE = 3
+# Levels kept in memory, least recently used ones beyond this are unloaded
+LOADED_LEVEL_LIMIT = 2
+
+# Loads level backgrounds and deferred assets off the main thread
+asset_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asset-loader')
 
 
 class GameStartingItem(PositionBasedSprite):
     current_level = None
-    tree_image = pygame.image.load('assets/tree.png').convert_alpha()
+    tree_image: Surface
     levels = []
+    _use_counter = 0
 
-    def __init__(self, number):
+    def __init__(self, number, meta=None):
         super().__init__(1)
         self.levels.append(self)
+        self.meta = {} if meta is None else meta
         self.position += (-number * 2.5 - 1, 2)
         self.number = number
         self.save_bit = 2**number
         foreground_sprites.add(self)
-        self.base_image = Surface((22, 22)).convert_alpha()
         self._create_base_image()
-        self.data = self._load_data()
-        if self.data.success:
-            self.background = pygame.transform.scale(
-                pygame.image.load(self.data.bgpath).subsurface(self.data.bgrect),
-                size
-            )
+        self.last_used = 0
+        self._unload()
+
+    def _unload(self):
+        self._data = None
+        self._background = None
+        self.tile_layer = None
+        self.overlay_layer = None
+
+    def _touch(self):
+        GameStartingItem._use_counter += 1
+        self.last_used = GameStartingItem._use_counter
+
+    @property
+    def data(self) -> LevelData:
+        if self._data is None:
+            self._data = self._load_data()
+            self._touch()
+            self.evict_levels()
+        elif isinstance(self._data, Future):
+            self._data = self._data.result()
+        return self._data
+
+    @staticmethod
+    def _load_background(path, rect, target_size):
+        return pygame.transform.scale(pygame.image.load(path).subsurface(rect), target_size)
+
+    @property
+    def background(self) -> Surface:
+        if isinstance(self._background, Future):
+            self._background = self._background.result()
+        if self._background is None:
+            self._background = self._load_background(self.data.bgpath, self.data.bgrect, size)
+        return self._background
+
+    def _load_prefetched_background(self, data, target_size):
+        # The asset loader has one thread, so the data was loaded before this
+        if isinstance(data, Future):
+            data = data.result()
+        if not data.success:
+            return None
+        audio.prefetch(data.song_path)
+        return self._load_background(data.bgpath, data.bgrect, target_size)
+
+    def prefetch(self):
+        """Start loading the level data and then the background on the asset loader."""
+        if self._data is None:
+            self._data = asset_loader.submit(self._load_data)
+            self._touch()
+            self.evict_levels()
+        if self._background is None:
+            self._background = asset_loader.submit(self._load_prefetched_background, self._data, size)
+
+    @classmethod
+    def prefetch_nearest(cls, position: Vector2):
+        candidates = [level for level in cls.levels if level.is_unlocked()]
+        if not candidates:
+            return
+        nearest = min(candidates, key=lambda level: level.position.distance_squared_to(position))
+        if nearest.position.distance_squared_to(position) <= LEVEL_PREFETCH_DISTANCE ** 2:
+            nearest.prefetch()
+
+    @classmethod
+    def evict_levels(cls):
+        loaded = [level for level in cls.levels
+                  if level._data is not None and level is not cls.current_level]
+        loaded.sort(key=lambda level: level.last_used)
+        for level in loaded[:max(0, len(loaded) - LOADED_LEVEL_LIMIT)]:
+            level._unload()
 
     def _create_base_image(self):
         background_color = (0, 0, 0, 0)
@@ -726,9 +1844,11 @@ class GameStartingItem(PositionBasedSprite):
             background_color = (0, 255, 0, 128)
         elif not self.is_unlocked():
             background_color = (255, 0, 0, 128)
+        # A new surface each time, the transform cache is keyed on identity
+        self.base_image = Surface((22, 22)).convert_alpha()
         self.base_image.fill(background_color)
         self.base_image.blit(self.tree_image, self.tree_image.get_rect())
-        text = level_font.render(str(self.number + 1), False, WHITE)
+        text = text_cache.render(level_font, str(self.number + 1), False, WHITE)
         rect = text.get_rect()
         rect.x = rect.x + 11 - rect.width // 2
         rect.y = rect.y + 11 - rect.height // 2
@@ -741,42 +1861,40 @@ class GameStartingItem(PositionBasedSprite):
         return save_game['checkpoints'] & last_level.save_bit
 
     def _load_data(self) -> LevelData:
-        cached_level = f'cache/level{self.number}.pkl'
-        if os.path.exists(cached_level):
-            with open(cached_level, 'rb') as fp:
-                result = pickle.load(fp)
-                if not isinstance(result, LevelData):
-                    raise TypeError('Cached level is not an instance of LevelData')
-                return result
-        else:
-            result = LevelData(self.number)
-            with open(cached_level, 'wb') as fp:
-                pickle.dump(result, fp)
-            return result
+        return LevelData(self.number)
 
     def update(self, *args, **kwargs):
         if self.is_unlocked() and self.rect.colliderect(player.rect):
-            print('Level', self.number, 'started')
-            global mode_2d
-            mode_2d = True
-            movement.update(0, 0)
-            foreground_sprites.remove(*self.levels)
-            self.data.enemies[:] = (enemy.create_enemy() for enemy in self.data.enemies)
-            Enemy.enemies.extend(self.data.enemies)
-            for enemy in Enemy.enemies:
-                enemy.activate()
-            self._begin_level()
+            self.start()
+
+    def start(self):
+        print('Level', self.number, 'started')
+        self._touch()
+        global mode_2d
+        mode_2d = True
+        movement.update(0, 0)
+        foreground_sprites.remove(*self.levels)
+        self.data.enemies[:] = (enemy.create_enemy() for enemy in self.data.enemies)
+        Enemy.enemies.extend(self.data.enemies)
+        for enemy in Enemy.enemies:
+            enemy.activate()
+        self._begin_level()
 
     def _begin_level(self):
         GameStartingItem.current_level = self
-        foreground_sprites.add(*self.data.iter_tiles())
+        if self.tile_layer is None:
+            self.tile_layer = TileMapLayer(self.data)
+            self.overlay_layer = TileMapLayer(self.data, overlay=True)
         # space.add(self.data.shape)
         player.vertical_velocity = 0
         player.position.update(self.get_spawn())
+        player.snap()
+        player.trigger_cell = None
+        camera.snap()
         switch_music(self.data.song_path)
+        audio.prefetch(map_song_path())
 
     def _end_level(self):
-        foreground_sprites.remove(*self.data.iter_tiles())
         play_map_music()
         # space.remove(self.data.shape)
 
@@ -789,7 +1907,7 @@ class GameStartingItem(PositionBasedSprite):
         Enemy.remove_enemies()
         if because_beat:
             save_game['levels'] |= self.save_bit
-            if self.data.final_level:
+            if self.meta.get('final_level', False):
                 save_game['game_beat'] = True
                 death_counter.rect, death_counter.content = create_death_counter()
         for level in self.levels:
@@ -803,16 +1921,6 @@ class GameStartingItem(PositionBasedSprite):
             return self.data.checkpoint
         return self.data.startpoint
 
-level0 = GameStartingItem(0)
-level1 = GameStartingItem(1)
-level2 = GameStartingItem(2)
-
-
-# background_sprites = pygame.sprite.Group()
-# background_sprites.add(Background(max(total_size)))
-background = StandalonePositionBasedRenderer(bg_image, map_point)
-foreground_sprites.add(player)
-
 
 ui_group = pygame.sprite.Group()
 
@@ -829,7 +1937,9 @@ class UIImage(pygame.sprite.Sprite):
 
     @content.setter
     def content(self, value):
-        self.image = pygame.transform.scale(value, self.rect.size)
+        if value.get_size() != self.rect.size:
+            value = pygame.transform.scale(value, self.rect.size)
+        self.image = value
 
 
 def inverted_colors(img):
@@ -840,21 +1950,29 @@ def inverted_colors(img):
 
 
 class UIButton(pygame.sprite.Sprite):
-    bgleft = pygame.image.load('assets/button-bg-left.png').convert_alpha()
-    bgmiddle = pygame.image.load('assets/button-bg-middle.png').convert_alpha()
-    bgright = pygame.image.load('assets/button-bg-right.png').convert_alpha()
+    bgleft: Surface
+    bgmiddle: Surface
+    bgright: Surface
 
     def __init__(self, content: Surface, rect: Rect, commands: Callable[[Event], None] = None, include_background=True):
         if commands is None:
             commands = []
         super().__init__(ui_group)
-        self.background = Surface(rect.size, pygame.SRCALPHA, 32).convert_alpha()
         self.content = content
         self.rect = rect
         self.commands = commands
         self.include_background = include_background
+        self.hovered = False
+        # Composed images by hover state, for the rect size and content in
+        # _images_key
+        self._images = {}
+        self._images_key = None
+        self._elements_height = None
+
+    def _scale_background_elements(self):
+        height = self.rect.height
         self.background_elements = [
-            pygame.transform.scale(element, (11, rect.height))
+            pygame.transform.scale(element, (11, height))
             for element in (self.bgleft, self.bgmiddle, self.bgright)
         ]
         self.inverted_background_elements = [
@@ -870,31 +1988,39 @@ class UIButton(pygame.sprite.Sprite):
             array[array == LIGHT_BLUE] = DARK_BLUE
             array[array == DARK_BLUE] = LIGHT_BLUE
             del array
-    
-    def _call(self, event):
-        for command in self.commands:
-            command(event)
+        self._elements_height = height
 
-    def update(self, mouse_events):
+    def _compose(self, hovered):
+        image = Surface(self.rect.size, pygame.SRCALPHA, 32).convert_alpha()
         if self.include_background:
-            self.background.fill((0, 0, 0, 0))
-            if self.rect.collidepoint(pygame.mouse.get_pos()):
+            if self._elements_height != self.rect.height:
+                self._scale_background_elements()
+            if hovered:
                 elements = self.inverted_background_elements
             else:
                 elements = self.background_elements
-            self.background.blit(
+            image.blit(
                 elements[0],
                 Rect(0, 0, 11, self.rect.height)
             )
             for i in range(1, self.rect.width // 11):
-                self.background.blit(
+                image.blit(
                     elements[1],
                     Rect(i * 11, 0, 11, self.rect.height)
                 )
-            self.background.blit(
+            image.blit(
                 elements[2],
                 Rect(self.rect.width - 11, 0, 11, self.rect.height)
             )
+        image.blit(self.content, Rect((0, 0), self.rect.size))
+        return image
+    
+    def _call(self, event):
+        for command in self.commands:
+            command(event)
+
+    def update(self, mouse_events):
+        self.hovered = self.rect.collidepoint(pygame.mouse.get_pos())
         for event in mouse_events:
             if (
                 event.type == MOUSEBUTTONUP
@@ -906,9 +2032,15 @@ class UIButton(pygame.sprite.Sprite):
 
     @property
     def image(self):
-        result = self.background.copy()
-        result.blit(self.content, Rect((0, 0), self.rect.size))
-        return result
+        # Holding the content itself, an id could be reused by a new surface
+        key = (self.rect.size, self.content, self.include_background)
+        if key != self._images_key:
+            self._images.clear()
+            self._images_key = key
+        image = self._images.get(self.hovered)
+        if image is None:
+            image = self._images[self.hovered] = self._compose(self.hovered)
+        return image
 
 
 def on_quit_button(event):
@@ -918,51 +2050,226 @@ def on_quit_button(event):
         global running
         running = False
 
-quit_button = UIButton(
-    pygame.transform.scale(
-        pygame.image.load('assets/exit.png').convert_alpha(), (50, 50)),
-    Rect(size[0] - 60, 10, 50, 50),
-    [on_quit_button]
-)
+quit_button: UIButton = None
 
 
-death_font = pygame.font.SysFont('calibri', 100)
+death_font: pygame.font.Font = None
 
 def create_death_counter(newrect=Rect(20, 20, 1000, 100)):
     value = f"Deaths: {save_game['death_count']}"
     if save_game['game_beat']:
         value += '        You beat the game!'
-    rendered_font = death_font.render(value, True, WHITE)
-    rect = rendered_font.get_rect().fit(newrect)
-    return rect, rendered_font
+    return text_cache.render_fitted(death_font, value, True, WHITE, newrect)
+
+death_counter: UIImage = None
+
 
-death_counter = UIImage(*reversed(create_death_counter()))
+class AudioWorker:
+    """Plays music on one long-lived background thread.
+
+    switch() and prefetch() only queue a command, so the main loop never
+    waits on the mixer or the disk. Switches are debounced: of those queued
+    or made during a fade out, only the latest is played. Songs are read
+    into memory first, keeping the last AUDIO_PREFETCH_LIMIT of them, so
+    prefetch() lets a later switch start without touching the disk.
+    """
+
+    def __init__(self):
+        self._commands = queue.Queue()
+        self._thread = None
+        self._song_data = OrderedDict()
+        self.current = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker_loop, name='audio', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def switch(self, song_path, fadeout_time=1):
+        """Fade out the current song over fadeout_time seconds and play song_path."""
+        if self._thread is not None:
+            self._commands.put(('switch', song_path, fadeout_time))
+
+    def prefetch(self, song_path):
+        if self._thread is not None:
+            self._commands.put(('prefetch', song_path))
+
+    def close(self):
+        if self._thread is not None:
+            self._commands.put(('close',))
+            self._thread.join()
+            self._thread = None
+
+    def _worker_loop(self):
+        pending = None
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                command = self._commands.get(timeout=timeout)
+            except queue.Empty:
+                # Fade out done and nothing newer queued
+                self._play(pending)
+                pending = deadline = None
+                continue
+            if command[0] == 'close':
+                return
+            elif command[0] == 'prefetch':
+                self._read(command[1])
+            else:
+                (_, pending, fadeout_time) = command
+                if deadline is None:
+                    if pygame.mixer.music.get_busy():
+                        pygame.mixer.music.fadeout(int(fadeout_time * 1000))
+                        deadline = time.monotonic() + fadeout_time
+                    else:
+                        deadline = time.monotonic()
+
+    def _read(self, song_path):
+        if song_path in self._song_data:
+            self._song_data.move_to_end(song_path)
+            return self._song_data[song_path]
+        try:
+            with open(song_path, 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        self._song_data[song_path] = data
+        while len(self._song_data) > AUDIO_PREFETCH_LIMIT:
+            self._song_data.popitem(last=False)
+        return data
+
+    def _play(self, song_path):
+        data = self._read(song_path)
+        try:
+            if data is None:
+                pygame.mixer.music.load(song_path)
+            else:
+                pygame.mixer.music.load(io.BytesIO(data), os.path.splitext(song_path)[1][1:])
+            pygame.mixer.music.play(-1)
+        except pygame.error as e:
+            print(f'Warning: could not play {song_path}: {e}')
+        self.current = song_path
+
+audio = AudioWorker()
 
 
 def switch_music(song_path, fadeout_time=1):
-    if not use_sound:
-        return
+    if use_sound:
+        audio.switch(song_path, fadeout_time)
 
-    def start_song(pause_time):
-        time.sleep(pause_time)
-        if not pygame.get_init():
-            return
-        pygame.mixer.music.load(song_path)
-        pygame.mixer.music.play(-1)
 
-    if pygame.mixer.music.get_busy():
-        pygame.mixer.music.fadeout(fadeout_time)
-        threading.Thread(target=start_song, args=[fadeout_time], daemon=False).start()
-    else:
-        start_song(0)
+def map_song_path():
+    if not save_game['levels']:
+        return 'assets/map0.wav'
+    return 'assets/map1.wav'
 
 
 def play_map_music():
-    if not save_game['levels']:
-        song_path = 'assets/map0.wav'
-    else:
-        song_path = 'assets/map1.wav'
-    switch_music(song_path)
+    switch_music(map_song_path())
+
+
+def load_assets():
+    global level_font, death_font
+    Player.player_raw_image = pygame.image.load('assets/player.png').convert_alpha()
+    Enemy.base_image = pygame.image.load('assets/enemy.png').convert_alpha()
+    GameStartingItem.tree_image = pygame.image.load('assets/tree.png').convert_alpha()
+    UIButton.bgleft = pygame.image.load('assets/button-bg-left.png').convert_alpha()
+    UIButton.bgmiddle = pygame.image.load('assets/button-bg-middle.png').convert_alpha()
+    UIButton.bgright = pygame.image.load('assets/button-bg-right.png').convert_alpha()
+    level_font = pygame.font.SysFont('calibri', 20)
+    death_font = pygame.font.SysFont('calibri', 100)
+
+
+def create_world(bg_image: Surface):
+    global player, background, quit_button, death_counter
+    player = Player()
+    for (level_number, level_meta) in enumerate(discover_levels()):
+        GameStartingItem(level_number, level_meta)
+
+    Background.base_image = bg_image
+    # background_sprites = pygame.sprite.Group()
+    # background_sprites.add(Background(max(total_size)))
+    background = StandalonePositionBasedRenderer(bg_image, map_point)
+    foreground_sprites.add(player)
+
+    # The real icon is loaded after the first frame by load_ui_assets()
+    quit_button = UIButton(
+        Surface((50, 50), SRCALPHA),
+        Rect(size[0] - 60, 10, 50, 50),
+        [on_quit_button]
+    )
+    death_counter = UIImage(*reversed(create_death_counter()))
+
+
+pending_assets = []
+
+
+def load_ui_assets():
+    """Start loading assets the first frame can do without."""
+    def load_exit_icon():
+        return pygame.transform.smoothscale(pygame.image.load('assets/exit.png'), (50, 50))
+
+    def apply_exit_icon(icon):
+        quit_button.content = icon.convert_alpha()
+
+    future = asset_loader.submit(load_exit_icon)
+    pending_assets.append((future, apply_exit_icon))
+    return future
+
+
+def apply_loaded_assets():
+    for (future, apply) in pending_assets[:]:
+        if future.done():
+            pending_assets.remove((future, apply))
+            apply(future.result())
+
+
+class StartupProfile:
+    """Times the startup stages and reports them with --startup-profile."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = [('import', time.perf_counter() - _import_start)]
+        self._first_frame = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def first_frame(self):
+        self._first_frame = time.perf_counter() - _import_start
+
+    def report(self):
+        if not self.enabled:
+            return
+        print('Startup profile:')
+        for (name, duration) in self.timings:
+            print(f'  {name:<12}{duration * 1000:8.1f} ms')
+        if self._first_frame is not None:
+            print(f'  {"first frame":<12}{self._first_frame * 1000:8.1f} ms after import started')
+
+
+def init(profile: StartupProfile = None, vsync=False):
+    """Run the startup stages needed before the first frame."""
+    if profile is None:
+        profile = StartupProfile(False)
+    with profile.stage('display'):
+        init_display(vsync)
+    with profile.stage('assets'):
+        load_assets()
+    with profile.stage('save data'):
+        load_save_data()
+    with profile.stage('map'):
+        bg_image = load_map_background()
+    with profile.stage('levels'):
+        create_world(bg_image)
+    return profile
 
 
 movement = Vector2()
@@ -970,41 +2277,30 @@ movement = Vector2()
 running = True
 smoothfps = FPS if FPS > 0 else 1000
 fps_smoothing = 0.9
+delta_time = 0
 fixed_fps_passed = 0
+# How far drawing is between the last two physics steps
+physics_alpha = 1.0
 
 MOUSE_EVENT_TYPES = [MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, MOUSEWHEEL]
 mouse_events = []
 
 pressed_keys = set()
-skip_physics = 0
 
-play_map_music()
 
-while running:
+def handle_events(waited_events=()):
+    """Process input, returning whether there was any.
 
-    delta_time = clock.tick(FPS) / 1000     ## will make the loop run at the same speed all the time
-    if delta_time > 0:
-        thisfps = 1 / delta_time
-    else:
-        thisfps = 1000
-    smoothfps = (smoothfps * fps_smoothing) + (thisfps * (1 - fps_smoothing))
-    if delta_time > fixed_fps_delta and skip_physics == 0:
-        skip_physics = 1
-    elif skip_physics == 2:
-        skip_physics = 0
-    # if delta_time > 0:
-    #     print('FPS:', 1/delta_time, ' '*24, end='\r')
-    # else:
-    #     print('FPS:', '>1000', ' '*24, end='\r')
-    stdout.write(f'FPS: {int(smoothfps)}{" " * 24}\r')
-
-    fixed_fps_passed += delta_time
-    
+    waited_events were already taken off the queue and come before it.
+    """
+    global running
     # if mode_2d:
     #     movement.y = 0
     mouse_events.clear()
+    had_events = False
     #1 Process input/events
-    for event in pygame.event.get():        # gets all the events which have occured till now and keeps tab of them.
+    for event in [*waited_events, *pygame.event.get()]:        # gets all the events which have occured till now and keeps tab of them.
+        had_events = True
         ## listening for the the X button at the top
         if event.type == pygame.QUIT:
             running = False
@@ -1018,7 +2314,8 @@ while running:
                 if event.key in (K_SPACE, K_RETURN):
                     movement.y = 1
         elif event.type == KEYUP:
-            pressed_keys.remove(event.key)
+            # A key held since before the window had focus has no KEYDOWN
+            pressed_keys.discard(event.key)
             # if event.key in (K_a, K_d):
             #     movement.x = 0
             if mode_2d:
@@ -1026,6 +2323,9 @@ while running:
                     movement.y = 0
         elif event.type in MOUSE_EVENT_TYPES:
             mouse_events.append(event)
+        elif event.type == VIDEOEXPOSE:
+            # The window contents were lost, e.g. uncovered
+            dirty_tracker.invalidate()
 
     movement.x = 0
     if K_a in pressed_keys:
@@ -1038,30 +2338,249 @@ while running:
             movement.y += 1
         if K_s in pressed_keys:
             movement.y -= 1
+    return had_events
+
 
-    #2 Update
+def update_world():
     # background_sprites.update()
     foreground_sprites.update()
-    camera.update(player)
+    if not mode_2d:
+        GameStartingItem.prefetch_nearest(player.position)
+        camera.update(player, delta_time)
+
 
-    #3 Draw/render
+def draw_world(surface: Surface):
     if mode_2d:
-        # screen.fill(BLACK)
-        screen.blit(GameStartingItem.current_level.background, Rect((0, 0), size))
+        # surface.fill(BLACK)
+        surface.blit(GameStartingItem.current_level.background, Rect((0, 0), size))
+        GameStartingItem.current_level.tile_layer.draw(surface)
 
-    # background_sprites.draw(screen)
+    # background_sprites.draw(surface)
     if not mode_2d:
-        background.draw(screen)
-    foreground_sprites.draw(screen)
-
-    while fixed_fps_passed > fixed_fps_delta:
-        fixed_fps_passed = 0
+        background.draw(surface)
+    foreground_sprites.draw(surface)
+    if mode_2d:
+        GameStartingItem.current_level.overlay_layer.draw(surface)
+
+
+def physics_step():
+    global fixed_fps_passed, physics_alpha
+    # Sprite rects are only interpolated between steps, not during them
+    physics_alpha = 1.0
+    steps = 0
+    while fixed_fps_passed >= fixed_fps_delta:
+        if steps == MAX_PHYSICS_STEPS:
+            fixed_fps_passed %= fixed_fps_delta
+            break
+        fixed_fps_passed -= fixed_fps_delta
+        steps += 1
         if mode_2d:
+            camera.begin_step()
+            PhysicsEnabledSprite.store_previous_positions()
+            player.fixed_update()
             PhysicsEnabledSprite.global_physics_update()
+            player.check_level_position()
+        # Reaching the goal leaves the level
+        if mode_2d:
+            camera.fixed_update(player)
+    physics_alpha = fixed_fps_passed / fixed_fps_delta
+    if mode_2d:
+        camera.interpolate(physics_alpha)
+
 
+def draw_ui(surface: Surface):
     ## Done after drawing everything to the screen
     ui_group.update(mouse_events)
-    ui_group.draw(screen)
-    pygame.display.flip()       
+    ui_group.draw(surface)
+
+
+class DirtyRectTracker:
+    """Works out which parts of the screen changed since the last frame.
 
-pygame.quit()
+    Sprites are compared by their rect and image. Anything that moves the
+    whole view, like a camera pan, a resize or switching to a level, calls
+    for a full redraw instead.
+    """
+
+    def __init__(self):
+        self.drawn = {}
+        self.view = None
+
+    def invalidate(self):
+        self.view = None
+
+    def changed_rects(self, sprites):
+        """Return the rects to redraw, or None if the whole screen should be."""
+        view = (mode_2d, transform_epoch, camera.position.x, camera.position.y)
+        # The images are kept so a new image can't reuse an old one's id
+        drawn = {sprite: (Rect(sprite.rect), sprite.image) for sprite in sprites}
+        previous = self.drawn
+        self.drawn = drawn
+        if view != self.view:
+            self.view = view
+            return None
+        rects = []
+        for (sprite, (rect, image)) in drawn.items():
+            old = previous.pop(sprite, None)
+            if old is None:
+                rects.append(rect)
+            elif old[0] != rect or old[1] is not image:
+                rects.append(rect.union(old[0]))
+        # Sprites that were removed or went out of view
+        rects.extend(old_rect for (old_rect, _) in previous.values())
+        rects = [rect for rect in rects if rect.width and rect.height]
+        if len(rects) > MAX_DIRTY_RECTS:
+            rects = [rects[0].unionall(rects[1:])]
+        return rects
+
+dirty_tracker = DirtyRectTracker()
+
+
+def present_frame(surface: Surface):
+    """Draw the world and UI and show them.
+
+    On the overworld only the changed rects are redrawn and pushed to the
+    display, and a frame where nothing changed costs nothing.
+    """
+    if mode_2d or not DIRTY_RECTS:
+        dirty_tracker.invalidate()
+        draw_world(surface)
+        draw_ui(surface)
+        pygame.display.flip()
+        return
+    ui_group.update(mouse_events)
+    # Collected once, then each dirty rect only blits the ones overlapping it
+    sprites = foreground_sprites.visible_sprites() + ui_group.sprites()
+    rects = dirty_tracker.changed_rects(sprites)
+    if rects is None:
+        draw_world(surface)
+        ui_group.draw(surface)
+        pygame.display.flip()
+        return
+    for rect in rects:
+        surface.set_clip(rect)
+        background.draw(surface)
+        surface.blits([(sprite.image, sprite.rect) for sprite in sprites if sprite.rect.colliderect(rect)],
+                      doreturn=False)
+    surface.set_clip(None)
+    if rects:
+        pygame.display.update(rects)
+
+
+def world_is_idle():
+    """Whether a frame drawn now would look the same as the last one."""
+    if movement or pressed_keys or pending_assets or not camera.converged:
+        return False
+    if mode_2d:
+        if player.vertical_velocity or not player.grounded:
+            return False
+        # Enemies only move while on screen
+        screen_rect = Rect((0, 0), size)
+        for enemy in Enemy.enemies:
+            if not enemy.asleep and screen_rect.colliderect(enemy.rect):
+                return False
+    return True
+
+
+class FramePacer:
+    """Waits out the rest of each frame.
+
+    Runs at `fps` (0 for uncapped) or at the display refresh rate with vsync,
+    and drops to IDLE_FPS, sleeping until input arrives, once the world has
+    been idle for IDLE_DELAY seconds.
+    """
+
+    def __init__(self, fps=FPS, vsync=False):
+        self.fps = fps
+        self.vsync = vsync
+        self.idle_time = 0
+        # Taken off the queue while idle, for handle_events()
+        self._waited_events = []
+
+    @property
+    def idle(self):
+        return self.idle_time >= IDLE_DELAY
+
+    def tick(self):
+        """Wait for the next frame and return the seconds since the last one."""
+        if self.idle:
+            event = pygame.event.wait(1000 // IDLE_FPS)
+            if event.type != NOEVENT:
+                # Re-posting it would put it behind events queued after it
+                self._waited_events.append(event)
+            return clock.tick() / 1000
+        # With vsync, flip() already waits for the display
+        return clock.tick(0 if self.vsync else self.fps) / 1000
+
+    def take_waited_events(self):
+        """Return the events tick() took off the queue, oldest first."""
+        events = self._waited_events
+        self._waited_events = []
+        return events
+
+    def update(self, had_events):
+        if had_events or not world_is_idle():
+            self.idle_time = 0
+        else:
+            self.idle_time += delta_time
+
+
+def main(argv=None):
+    global delta_time, smoothfps, fixed_fps_passed
+    parser = argparse.ArgumentParser(description='Marooned!')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print how long each startup stage took')
+    parser.add_argument('--fps', type=int, default=FPS,
+                        help='frame rate cap, 0 for uncapped (default: %(default)s)')
+    parser.add_argument('--vsync', action='store_true',
+                        help='pace frames to the display refresh rate')
+    args = parser.parse_args(argv)
+
+    profile = init(StartupProfile(args.startup_profile), args.vsync)
+    pacer = FramePacer(args.fps, args.vsync)
+    first_frame = True
+
+    while running:
+
+        delta_time = pacer.tick()     ## will make the loop run at the same speed all the time
+        if delta_time > 0:
+            thisfps = 1 / delta_time
+        else:
+            thisfps = 1000
+        smoothfps = (smoothfps * fps_smoothing) + (thisfps * (1 - fps_smoothing))
+        # if delta_time > 0:
+        #     print('FPS:', 1/delta_time, ' '*24, end='\r')
+        # else:
+        #     print('FPS:', '>1000', ' '*24, end='\r')
+        stdout.write(f'FPS: {int(smoothfps)}{" " * 24}\r')
+
+        fixed_fps_passed += delta_time
+
+        had_events = handle_events(pacer.take_waited_events())
+
+        #2 Update
+        physics_step()
+        update_world()
+        pacer.update(had_events)
+
+        #3 Draw/render
+        present_frame(screen)
+
+        if first_frame:
+            first_frame = False
+            profile.first_frame()
+            # Deferred stages, off the path to the first frame
+            with profile.stage('audio'):
+                init_audio()
+            with profile.stage('ui assets'):
+                load_ui_assets()
+            profile.report()
+        apply_loaded_assets()
+
+    save_game.close()
+    audio.close()
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
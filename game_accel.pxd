@@ -0,0 +1,12 @@
+cpdef int tile_contacts(const unsigned char[:, :] tile_grid, const unsigned char[:] collidable,
+                        double x, double y, long rect_x, long rect_y, long rect_width, long rect_height,
+                        double camera_x, double camera_y, double offset_x, double offset_y,
+                        double scale, double screen_height, double cull_width, double cull_height)
+cpdef bint place_rect(object rect, object image_rect, double x, double y,
+                      double camera_x, double camera_y, double offset_x, double offset_y,
+                      double scale, double screen_height, double cull_width, double cull_height,
+                      bint cull)
+cpdef tuple view_origin(double x, double y, double camera_x, double camera_y,
+                        double offset_x, double offset_y, double scale, double screen_height)
+cpdef double step_velocity(double velocity, bint grounded, bint ceiling, double gravity)
+cpdef classify_pixels(const unsigned int[:, :] pixels, const unsigned int[:] colors)
@@ -0,0 +1,115 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""Compiled hot paths for game.py, built by setup.py.
+
+game_accel_py.py has the same functions in pure Python and is used when
+this module isn't built; keep the two in step.
+"""
+
+import numpy as np
+from libc.math cimport floor, nearbyint
+
+# Tiles probed around a sprite: itself, above, below, left and right
+PROBE_DIRECTIONS = ((0, 0), (0, 1), (0, -1), (-1, 0), (1, 0))
+cdef int[5] DX = [0, 0, 0, -1, 1]
+cdef int[5] DY = [0, 1, -1, 0, 0]
+
+
+cdef inline long py_round(double value):
+    # nearbyint rounds half to even, like Python's round()
+    return <long>nearbyint(value)
+
+
+cpdef int tile_contacts(const unsigned char[:, :] tile_grid, const unsigned char[:] collidable,
+                        double x, double y, long rect_x, long rect_y, long rect_width, long rect_height,
+                        double camera_x, double camera_y, double offset_x, double offset_y,
+                        double scale, double screen_height, double cull_width, double cull_height):
+    """Bit mask of the PROBE_DIRECTIONS from world position (x, y) that
+    have a collidable tile whose screen rect overlaps the given one.
+
+    tile_grid is indexed [x, map y] with map y counting down from the top;
+    collidable is a uint8 array of flags by tile id. Tiles are placed as
+    place_rect would place a culled, scale pixel wide tile image.
+    """
+    cdef Py_ssize_t width = tile_grid.shape[0]
+    cdef Py_ssize_t height = tile_grid.shape[1]
+    cdef long tile_size = <long>floor(scale)
+    cdef long map_x, map_y, tile_x, tile_y, left, top
+    cdef double screen_x, screen_y
+    cdef int i
+    cdef int result = 0
+    # Rect.colliderect never matches an empty rect
+    if rect_width <= 0 or rect_height <= 0 or tile_size <= 0:
+        return 0
+    for i in range(5):
+        tile_x = py_round(x + DX[i])
+        tile_y = py_round(y + DY[i])
+        map_x = tile_x
+        map_y = height - tile_y
+        if not (0 <= map_x < width and 0 <= map_y < height and collidable[tile_grid[map_x, map_y]]):
+            continue
+        screen_x = tile_x + (offset_x - camera_x)
+        screen_y = tile_y + (offset_y - camera_y)
+        if screen_x < -1 or screen_y < -1 or screen_x > cull_width + 1 or screen_y > cull_height + 1:
+            continue
+        left = <long>(screen_x * scale)
+        top = py_round(screen_height - <long>(screen_y * scale))
+        if (rect_x < left + tile_size and left < rect_x + rect_width
+                and rect_y < top + tile_size and top < rect_y + rect_height):
+            result |= 1 << i
+    return result
+
+
+cpdef bint place_rect(object rect, object image_rect, double x, double y,
+                      double camera_x, double camera_y, double offset_x, double offset_y,
+                      double scale, double screen_height, double cull_width, double cull_height,
+                      bint cull):
+    """Update rect in place to image_rect drawn at world position (x, y).
+
+    If cull is true and the position is more than one unit outside the
+    cull_width by cull_height view, leave rect alone and return False.
+    """
+    x += offset_x - camera_x
+    y += offset_y - camera_y
+    if cull and (x < -1 or y < -1 or x > cull_width + 1 or y > cull_height + 1):
+        return False
+    rect.update(image_rect.x + <long>(x * scale),
+                image_rect.y + py_round(screen_height - <long>(y * scale)),
+                image_rect.width, image_rect.height)
+    return True
+
+
+cpdef tuple view_origin(double x, double y, double camera_x, double camera_y,
+                        double offset_x, double offset_y, double scale, double screen_height):
+    """Top left of the screen relative to a surface drawn at world position (x, y)."""
+    cdef long screen_x = <long>((x + offset_x - camera_x) * scale)
+    cdef long screen_y = <long>((y + offset_y - camera_y) * scale)
+    return (-<double>screen_x, -(screen_height - screen_y))
+
+
+cpdef double step_velocity(double velocity, bint grounded, bint ceiling, double gravity):
+    """Vertical velocity after one physics step."""
+    if not grounded:
+        velocity += gravity
+    if grounded:
+        velocity = max(0, velocity)
+    if ceiling:
+        velocity = min(0, velocity)
+    return velocity
+
+
+cpdef classify_pixels(const unsigned int[:, :] pixels, const unsigned int[:] colors):
+    """Map each pixel to 1 + the index of its color in colors, or 0 if it
+    isn't one of them."""
+    result = np.zeros((pixels.shape[0], pixels.shape[1]), np.uint8)
+    cdef unsigned char[:, :] out = result
+    cdef Py_ssize_t x, y, i
+    cdef Py_ssize_t count = colors.shape[0]
+    cdef unsigned int pixel
+    for x in range(pixels.shape[0]):
+        for y in range(pixels.shape[1]):
+            pixel = pixels[x, y]
+            for i in range(count):
+                if pixel == colors[i]:
+                    out[x, y] = i + 1
+                    break
+    return result
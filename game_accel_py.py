@@ -0,0 +1,90 @@
+"""Pure-Python versions of the hot paths in game_accel.pyx.
+
+game.py uses these when the compiled module hasn't been built (see
+setup.py). Both modules must keep the same API and give the same results;
+`python benchmark.py --compare-accel` checks that.
+"""
+
+import math
+
+import numpy as np
+
+# Tiles probed around a sprite: itself, above, below, left and right
+PROBE_DIRECTIONS = ((0, 0), (0, 1), (0, -1), (-1, 0), (1, 0))
+
+
+def tile_contacts(tile_grid, collidable, x, y, rect_x, rect_y, rect_width, rect_height,
+                  camera_x, camera_y, offset_x, offset_y, scale, screen_height, cull_width, cull_height):
+    """Bit mask of the PROBE_DIRECTIONS from world position (x, y) that
+    have a collidable tile whose screen rect overlaps the given one.
+
+    tile_grid is indexed [x, map y] with map y counting down from the top;
+    collidable is a uint8 array of flags by tile id. Tiles are placed as
+    place_rect would place a culled, scale pixel wide tile image.
+    """
+    (width, height) = tile_grid.shape
+    tile_size = math.floor(scale)
+    # Rect.colliderect never matches an empty rect
+    if rect_width <= 0 or rect_height <= 0 or tile_size <= 0:
+        return 0
+    result = 0
+    for (i, (dx, dy)) in enumerate(PROBE_DIRECTIONS):
+        tile_x = round(x + dx)
+        tile_y = round(y + dy)
+        map_y = height - tile_y
+        if not (0 <= tile_x < width and 0 <= map_y < height and collidable[tile_grid[tile_x, map_y]]):
+            continue
+        screen_x = tile_x + (offset_x - camera_x)
+        screen_y = tile_y + (offset_y - camera_y)
+        if screen_x < -1 or screen_y < -1 or screen_x > cull_width + 1 or screen_y > cull_height + 1:
+            continue
+        left = int(screen_x * scale)
+        top = round(screen_height - int(screen_y * scale))
+        if (rect_x < left + tile_size and left < rect_x + rect_width
+                and rect_y < top + tile_size and top < rect_y + rect_height):
+            result |= 1 << i
+    return result
+
+
+def place_rect(rect, image_rect, x, y, camera_x, camera_y, offset_x, offset_y,
+               scale, screen_height, cull_width, cull_height, cull):
+    """Update rect in place to image_rect drawn at world position (x, y).
+
+    If cull is true and the position is more than one unit outside the
+    cull_width by cull_height view, leave rect alone and return False.
+    """
+    x += offset_x - camera_x
+    y += offset_y - camera_y
+    if cull and (x < -1 or y < -1 or x > cull_width + 1 or y > cull_height + 1):
+        return False
+    rect.update(image_rect.x + int(x * scale),
+                image_rect.y + round(screen_height - int(y * scale)),
+                image_rect.width, image_rect.height)
+    return True
+
+
+def view_origin(x, y, camera_x, camera_y, offset_x, offset_y, scale, screen_height):
+    """Top left of the screen relative to a surface drawn at world position (x, y)."""
+    x = int((x + offset_x - camera_x) * scale)
+    y = int((y + offset_y - camera_y) * scale)
+    return (-float(x), -(screen_height - y))
+
+
+def step_velocity(velocity, grounded, ceiling, gravity):
+    """Vertical velocity after one physics step."""
+    if not grounded:
+        velocity += gravity
+    if grounded:
+        velocity = max(0, velocity)
+    if ceiling:
+        velocity = min(0, velocity)
+    return velocity
+
+
+def classify_pixels(pixels, colors):
+    """Map each pixel to 1 + the index of its color in colors, or 0 if it
+    isn't one of them."""
+    result = np.zeros(pixels.shape, np.uint8)
+    for (index, color) in enumerate(colors, 1):
+        result[pixels == color] = index
+    return result
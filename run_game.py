@@ -12,3 +12,4 @@ if should_build:
               ' (Are Cython and setuptools installed?)')
 
 import game
+game.main()
@@ -2,5 +2,7 @@ from setuptools import setup
 from Cython.Build import cythonize
 
 setup(
-    ext_modules = cythonize('game.py', compiler_directives={'language_level' : '3str'})
+    # Only the hot paths are compiled, game.py imports the built module and
+    # falls back to game_accel_py.py without it
+    ext_modules = cythonize('game_accel.pyx', compiler_directives={'language_level' : '3str'})
 )
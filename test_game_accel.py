@@ -0,0 +1,93 @@
+"""Tests for the hot paths in game_accel.pyx and game_accel_py.py.
+
+Run with `python -m pytest`. The compiled module is only tested once it
+has been built with `python setup.py build_ext --inplace`.
+"""
+
+import numpy as np
+import pytest
+from pygame import Rect
+
+import benchmark
+import game_accel_py
+
+try:
+    import game_accel
+except ImportError:
+    game_accel = None
+
+MODULES = [game_accel_py] + ([game_accel] if game_accel is not None else [])
+CASES = benchmark.accel_cases(0, 2000)
+
+# Scale 10, a 100 pixel high screen and no camera or offset, so world
+# position (x, y) is drawn at pixel (10x, 100 - 10y)
+VIEW = (0.0, 0.0, 0.0, 0.0, 10.0, 100.0, 10.0, 10.0)
+
+
+@pytest.mark.skipif(game_accel is None, reason='game_accel is not built')
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_compiled_matches_python(name):
+    for (i, case) in enumerate(CASES[name]):
+        (expected, expected_rects) = benchmark.call(getattr(game_accel_py, name), case)
+        (result, rects) = benchmark.call(getattr(game_accel, name), case)
+        assert benchmark.same_result(expected, result), f'{name} case {i}'
+        assert expected_rects == rects, f'{name} case {i}'
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_place_rect(accel):
+    rect = Rect(0, 0, 0, 0)
+    assert accel.place_rect(rect, Rect(-5, -5, 10, 10), 2.0, 3.0, *VIEW, True)
+    assert rect == Rect(15, 65, 10, 10)
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_place_rect_rounds_half_to_even(accel):
+    rect = Rect(0, 0, 0, 0)
+    accel.place_rect(rect, Rect(0, 0, 1, 1), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 2.5, 10.0, 10.0, False)
+    assert rect.y == 2
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_place_rect_culls(accel):
+    rect = Rect(1, 2, 3, 4)
+    assert not accel.place_rect(rect, Rect(0, 0, 10, 10), 20.0, 3.0, *VIEW, True)
+    assert rect == Rect(1, 2, 3, 4)
+    assert accel.place_rect(rect, Rect(0, 0, 10, 10), 20.0, 3.0, *VIEW, False)
+
+
+def ground_grid():
+    # 5x5 map with ground along the bottom row, world y 1
+    grid = np.zeros((5, 5), np.uint8)
+    grid[:, 4] = 1
+    return (grid, np.array([0, 1], np.uint8))
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_tile_contacts_ground(accel):
+    (grid, collidable) = ground_grid()
+    # Sunk a little into the ground below, drawn at (20, 81)
+    assert accel.tile_contacts(grid, collidable, 2.0, 1.9, 20, 81, 10, 10, *VIEW) == 1 << 2
+    # Resting exactly on it doesn't overlap
+    assert accel.tile_contacts(grid, collidable, 2.0, 2.0, 20, 80, 10, 10, *VIEW) == 0
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_tile_contacts_ignores_empty_rects_and_non_collidable_tiles(accel):
+    (grid, collidable) = ground_grid()
+    assert accel.tile_contacts(grid, collidable, 2.0, 1.9, 20, 81, 0, 0, *VIEW) == 0
+    assert accel.tile_contacts(grid, np.array([0, 0], np.uint8), 2.0, 1.9, 20, 81, 10, 10, *VIEW) == 0
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_step_velocity(accel):
+    assert accel.step_velocity(0.1, False, False, -0.005) == pytest.approx(0.095)
+    assert accel.step_velocity(-0.1, True, False, -0.005) == 0
+    assert accel.step_velocity(0.1, False, True, -0.005) == 0
+
+
+@pytest.mark.parametrize('accel', MODULES)
+def test_classify_pixels(accel):
+    colors = np.array([0xffffff, 0x008000], np.uint32)
+    pixels = np.array([[0xffffff, 0x123456], [0x008000, 0xffffff]], np.uint32)
+    assert (accel.classify_pixels(pixels, colors) == [[1, 0], [2, 1]]).all()